@@ -1,78 +1,483 @@
 import configparser
+import threading
 
-from elasticsearch import Elasticsearch
+from elasticsearch import (AsyncElasticsearch, BadRequestError, ConflictError, Elasticsearch, NotFoundError,
+                           helpers)
+from elasticsearch.helpers import async_bulk
 from fastapi import HTTPException
 
-from .RepositoryBase import RepoBase
+from .RepositoryBase import AsyncRepoBase, RepoBase, check_etag, decode_cursor, encode_cursor, filter_conditions
 
 config = configparser.ConfigParser()
 config.read('metarepo.conf')
 
+# Maximum results returned by a single find, "page" offsets by multiples of this
+_PAGE_SIZE = 1000
+# How long a find_page point in time stays open between calls
+_PIT_KEEP_ALIVE = "5m"
+
+# One client per process. It's thread safe and holds its own connection pool, so creating it
+# (and doing the TLS handshake) per call is pure overhead
+_client = None
+_client_lock = threading.Lock()
+_async_client = None # AsyncElasticsearchRepository's client, which belongs to the event loop
+_index_ready = False # Whether we've made sure the index exists, with our mappings
+
+# Mappings for a new "meta" index. Strings get a keyword subfield (as elasticsearch's defaults
+# do) for exact, prefix and range filters, but aren't guessed to be dates, so every string field
+# has one. Whole numbers and decimals share one numeric type, so a field's type doesn't depend
+# on whichever document happened to come first, and values that can't be read as a number are
+# left unindexed rather than failing the notate. An existing index keeps its mappings. To pick
+# these up copy it into a new index (see tools/copy_repo.py)
+_MAPPINGS = {
+    "date_detection": False,
+    "numeric_detection": False,
+    "dynamic_templates": [
+        {"numbers": {"match_mapping_type": "long",
+                     "mapping": {"type": "double", "ignore_malformed": True}}},
+        {"decimals": {"match_mapping_type": "double",
+                      "mapping": {"type": "double", "ignore_malformed": True}}},
+        {"strings": {"match_mapping_type": "string",
+                     "mapping": {"type": "text",
+                                 "fields": {"keyword": {"type": "keyword", "ignore_above": 1024}}}}},
+    ],
+    # Archives are only ever read back whole, and their "previous" values change shape from one
+    # entry to the next, which would otherwise be a mapping conflict
+    "properties": {
+        "frameworkArchive": {"type": "object", "enabled": False},
+        "metadataArchive": {"type": "object", "enabled": False},
+        "targetMetadataArchive": {"type": "object", "enabled": False},
+        "siteMetadataArchive": {"type": "object", "enabled": False},
+    },
+}
+
+
+def _create_client(client_class=Elasticsearch):
+    """Create the elasticsearch client, using details from the config"""
+    config_field = "ELASTICSEARCH"
+    els = client_class(
+         config.get(config_field, "elastic_url"),
+         ssl_assert_fingerprint=config.get(config_field, "cert_fingerprint"),
+         basic_auth=(
+                config.get(config_field, "elastic_user"),
+                config.get(config_field, "elastic_password")),
+         connections_per_node=config.getint(config_field, "connections_per_node", fallback=10),
+         request_timeout=config.getfloat(config_field, "request_timeout", fallback=10),
+         max_retries=config.getint(config_field, "max_retries", fallback=3),
+         retry_on_timeout=config.getboolean(config_field, "retry_on_timeout", fallback=False),
+         sniff_on_start=config.getboolean(config_field, "sniff_on_start", fallback=False),
+         sniff_on_node_failure=config.getboolean(config_field, "sniff_on_node_failure", fallback=False))
+    return els
+
+
+def _build_query(filters, groups):
+    """ Turn filters and groups into an elasticsearch query """
+    if not filters and not groups:
+        query = {"match_all": {}}
+    elif not filters and groups:
+        raise HTTPException(
+            status_code=401,
+            detail="If we're doing a find all, do NOT include groups")
+    else: # We have filters. We might not have groups, depending on tenancy and exactly what is being checked
+        query = {"bool": {"must": [], "filter": []}}
+        for tag in filters:
+            for op, operand in filter_conditions(filters[tag]):
+                if op == "eq" and tag == "docSetId": # Membership is exact, and scoring it is wasted work
+                    query["bool"]["filter"].append({"term": {"docSetId.keyword": operand}})
+                elif op == "eq":
+                    query["bool"]["must"].append({"match": {tag: operand}})
+                else: # Operators are filters, so they're answered from the index without scoring
+                    query["bool"]["filter"].append(_operator_query(tag, op, operand))
+        if groups:
+            group_query = {"bool": {"should": []}}
+            for group in groups:
+                group_query["bool"]["should"].append(
+                    {"term": {"siteMetadata.tenant": group}})
+            query["bool"]["must"].append(group_query)
+    return query
+
+
+def _operator_query(tag, op, operand):
+    """ The query for one filter operator. Strings are matched against the keyword subfield,
+    exactly and in order, and numbers against the field itself """
+    if op == "in":
+        strings = [item for item in operand if isinstance(item, str)]
+        numbers = [item for item in operand if not isinstance(item, str)]
+        should = []
+        if strings:
+            should.append({"terms": {f"{tag}.keyword": strings}})
+        if numbers:
+            should.append({"terms": {tag: numbers}})
+        return {"bool": {"should": should, "minimum_should_match": 1}}
+    if op == "prefix":
+        return {"prefix": {f"{tag}.keyword": operand}}
+    field = f"{tag}.keyword" if isinstance(operand, str) else tag
+    return {"range": {field: {op: operand}}}
+
+
+def _docset_count_search(doc_set_ids, filters, groups):
+    """ A search that counts the documents in each docSet with a terms aggregation on the
+    docSetId keyword, and returns no documents """
+    doc_set_ids = list(dict.fromkeys(doc_set_ids))
+    query = _build_query(dict(filters or {}, docSetId={"in": doc_set_ids}), groups)
+    aggs = {"docsets": {"terms": {"field": "docSetId.keyword", "include": doc_set_ids,
+                                  "size": len(doc_set_ids)}}}
+    return {"index": "meta", "size": 0, "query": query, "aggs": aggs}
+
+
+def _docset_counts(doc_set_ids, results):
+    counts = dict.fromkeys(doc_set_ids, 0)
+    for bucket in results["aggregations"]["docsets"]["buckets"]:
+        counts[bucket["key"]] = bucket["doc_count"]
+    return counts
+
+
+def _bulk_failures(errors):
+    """ Turn the per item errors from a bulk create into {docId: HTTPException} """
+    failures = {}
+    for error in errors:
+        item = next(iter(error.values()))
+        status = item.get("status", 500)
+        if status == 409:
+            failures[item["_id"]] = HTTPException(status_code=500,
+                                                  detail=f"Document {item['_id']} already exists in repo!")
+        else:
+            reason = item.get("error") or "unknown reason"
+            if isinstance(reason, dict):
+                reason = reason.get("reason", reason.get("type", "unknown reason"))
+            print(f"Notate of {item['_id']} failed: {reason}")
+            failures[item["_id"]] = HTTPException(status_code=400 if status == 400 else 500,
+                                                  detail=f"Notate failed: {reason}")
+    return failures
+
+
+def _ensure_index(els):
+    """ Create the index with our mappings before the first write, which would otherwise create
+    it with elasticsearch's guesses. Only checked once per process """
+    global _index_ready # pylint: disable=global-statement
+    if _index_ready:
+        return
+    if not els.indices.exists(index="meta"):
+        try:
+            els.indices.create(index="meta", mappings=_MAPPINGS)
+        except BadRequestError as ex: # Another worker created it first
+            if ex.error != "resource_already_exists_exception":
+                raise
+    _index_ready = True
+
+
+async def _ensure_index_async(els):
+    """ The same as _ensure_index, on the async client """
+    global _index_ready # pylint: disable=global-statement
+    if _index_ready:
+        return
+    if not await els.indices.exists(index="meta"):
+        try:
+            await els.indices.create(index="meta", mappings=_MAPPINGS)
+        except BadRequestError as ex:
+            if ex.error != "resource_already_exists_exception":
+                raise
+    _index_ready = True
+
+
+def _pit_cursor_state(cursor):
+    """ Pull the point in time id and search_after values out of a find_page cursor """
+    state = decode_cursor(cursor)
+    pit_id, search_after = state.get("pit"), state.get("after")
+    if pit_id is None or search_after is None:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return pit_id, search_after
+
+
+def _raise_if_pit_missing(cursor, ex):
+    """ A cursor's point in time is gone once it sits unused past _PIT_KEEP_ALIVE, and elasticsearch
+    answers with a 404. That's the caller's stale cursor, not a server error """
+    if cursor:
+        raise HTTPException(status_code=400,
+                            detail="Cursor expired, start again without it") from ex
+
+
+def _source_includes(fields):
+    """ Let elasticsearch cut the _source down, so unrequested archives never leave the cluster """
+    if fields is None:
+        return None
+    return ["docId"] + list(fields)
+
+
+def close_client():
+    """ Close the shared client, if one was created """
+    global _client # pylint: disable=global-statement
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
 class ElasticsearchRepository(RepoBase):
 
+    @classmethod
+    def close(cls):
+        close_client()
+
     def _connect_elasticsearch(self):
-        """Perform the connection to elasticsearch, using details from the config"""
-        config_field = "ELASTICSEARCH"
-        els = Elasticsearch(
-             config.get(config_field, "elastic_url"),
-             ssl_assert_fingerprint=config.get(config_field, "cert_fingerprint"),
-             basic_auth=(
-                    config.get(config_field, "elastic_user"),
-                    config.get(config_field, "elastic_password")))
-        return els
+        """Get the shared elasticsearch client, creating it on first use"""
+        global _client # pylint: disable=global-statement
+        if _client is None:
+            with _client_lock:
+                if _client is None:
+                    _client = _create_client()
+        return _client
     
-    def find(self, filters: dict=None, groups: list=None, page: int=0):
+    def find(self, filters: dict=None, groups: list=None, page: int=0, fields: list=None):
         if filters is None: filters = {}
         if groups is None: groups = []
-        
-        if not filters and not groups:
-            query = {"match_all": {}}
-        elif not filters and groups:
-            raise HTTPException(
-                status_code=401,
-                detail="If we're doing a find all, do NOT include groups")
-        else: # We have filters. We might not have groups, depending on tenancy and exactly what is being checked
-            query = {"bool": {"must": []}}
-            for tag in filters:
-                val = filters[tag]
-                query_field = {"match": {tag: val}}
-                query["bool"]["must"].append(query_field)
-            if groups:
-                group_query = {"bool": {"should": []}}
-                for group in groups:
-                    group_query["bool"]["should"].append(
-                        {"term": {"siteMetadata.tenant": group}})
-                query["bool"]["must"].append(group_query)
-                
-
-        
+        query = _build_query(filters, groups)
+
         # We can provide this query as is. It'll get sanitized when it gets
         # converted from dict to json
         els = self._connect_elasticsearch()
-        results = els.search(index="meta", query=query, size=1000, from_=page*1000)
+        results = els.search(index="meta", query=query, size=_PAGE_SIZE, from_=page*_PAGE_SIZE,
+                             source_includes=_source_includes(fields))
 
         # We only want to return the actual sheets, not the elasticsearch cruft
         results = results["hits"]["hits"]
         results = [doc["_source"] for doc in results]
 
         return results
+
+    def find_page(self, filters: dict=None, groups: list=None, cursor: str=None, fields: list=None):
+        """ Page with a point in time and search_after rather than from_, which is capped at
+        max_result_window and gets more expensive the deeper it goes """
+        if filters is None: filters = {}
+        if groups is None: groups = []
+        query = _build_query(filters, groups)
+        els = self._connect_elasticsearch()
+
+        if cursor:
+            pit_id, search_after = _pit_cursor_state(cursor)
+        else:
+            pit_id = els.open_point_in_time(index="meta", keep_alive=_PIT_KEEP_ALIVE)["id"]
+            search_after = None
+
+        # _shard_doc is the cheapest stable sort there is, and a point in time search always has it
+        try:
+            results = els.search(query=query, size=_PAGE_SIZE, sort=["_shard_doc"],
+                                 pit={"id": pit_id, "keep_alive": _PIT_KEEP_ALIVE},
+                                 search_after=search_after, source_includes=_source_includes(fields))
+        except NotFoundError as ex:
+            _raise_if_pit_missing(cursor, ex)
+            raise
+        pit_id = results.get("pit_id", pit_id) # The id can change between searches
+        hits = results["hits"]["hits"]
+
+        if len(hits) < _PAGE_SIZE:
+            els.close_point_in_time(id=pit_id)
+            next_cursor = None
+        else:
+            next_cursor = encode_cursor({"pit": pit_id, "after": hits[-1]["sort"]})
+        return [doc["_source"] for doc in hits], next_cursor
+
+    def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        if not doc_set_ids:
+            return {}
+        els = self._connect_elasticsearch()
+        results = els.search(**_docset_count_search(doc_set_ids, filters, groups))
+        return _docset_counts(doc_set_ids, results)
     
     def notate(self, doc: dict) -> None:
         doc_id = doc['docId']
         try:
             els = self._connect_elasticsearch()
+            _ensure_index(els)
             els.create(index="meta", id=doc_id, document=doc)
+        except ConflictError as ex:
+            raise HTTPException(status_code=500,
+                                detail=f"Document {doc_id} already exists in repo!") from ex
+        except Exception as ex:
+            print(f"Notate failed: {ex}")
+            raise HTTPException(status_code=500,
+                                detail="Notate failed for unknown reason")
+
+    def notate_many(self, docs: list) -> dict:
+        """ Items are indexed on their own, so some can fail while the rest go in. Those are
+        returned rather than raised """
+        actions = [{"_op_type": "create", "_index": "meta", "_id": doc["docId"], "_source": doc}
+                   for doc in docs]
+        try:
+            els = self._connect_elasticsearch()
+            _ensure_index(els)
+            _, errors = helpers.bulk(els, actions, raise_on_error=False)
         except Exception as ex:
-            print("Notate failed: " + ex.message)
+            print(f"Notate failed: {ex}")
+            raise HTTPException(status_code=500,
+                                detail="Notate failed for unknown reason")
+        return _bulk_failures(errors)
+
+    def get(self, doc_id: str, fields: list=None):
+        els = self._connect_elasticsearch()
+        try:
+            return els.get(index="meta", id=doc_id, source_includes=_source_includes(fields))["_source"]
+        except NotFoundError:
+            return None
+
+    def get_many(self, doc_ids: list, fields: list=None):
+        doc_ids = list(dict.fromkeys(doc_ids))
+        if not doc_ids:
+            return []
+        els = self._connect_elasticsearch()
+        res = els.mget(index="meta", ids=doc_ids, source_includes=_source_includes(fields))
+        return [doc["_source"] for doc in res["docs"] if doc.get("found")]
+
+    def update(self, doc_id: str, update_fields: dict, if_match: str=None) -> None:
+        els = self._connect_elasticsearch()
+        concurrency = {}
+        if if_match is not None:
+            # Check the version we read, then only write if elasticsearch still has that version
+            try:
+                current = els.get(index="meta", id=doc_id)
+            except NotFoundError as ex:
+                raise HTTPException(status_code=500,
+                                    detail=f"Document {doc_id} does not exist in repo!") from ex
+            check_etag(current["_source"], if_match)
+            concurrency = {"if_seq_no": current["_seq_no"], "if_primary_term": current["_primary_term"]}
+        try:
+            update = els.update(index="meta", id=doc_id, doc=update_fields, refresh=True, **concurrency)
+        except ConflictError as ex:
+            raise HTTPException(status_code=412,
+                                detail="Document has been modified since it was read") from ex
+        except Exception as ex:
+            print(f"Update failed: {ex}")
+            raise HTTPException(status_code=500,
+                                detail="Update failed for unknown reason")
+
+        # Elasticsearch didn't crash, but make sure the update was actually successful
+        if update["result"] not in ['successful', 'updated', 'noop']:
             raise HTTPException(status_code=500,
                                 detail="Update failed for unknown reason")
 
-    def update(self, doc_id: str, update_fields: dict) -> None:
+
+class AsyncElasticsearchRepository(AsyncRepoBase):
+    """ The same as ElasticsearchRepository, but on the async client """
+
+    @classmethod
+    async def aclose(cls):
+        global _async_client # pylint: disable=global-statement
+        if _async_client is not None:
+            await _async_client.close()
+            _async_client = None
+
+    def _connect_elasticsearch(self):
+        """Get the shared async elasticsearch client, creating it on first use"""
+        global _async_client # pylint: disable=global-statement
+        if _async_client is None:
+            _async_client = _create_client(AsyncElasticsearch)
+        return _async_client
+
+    async def find(self, filters: dict=None, groups: list=None, page: int=0, fields: list=None):
+        if filters is None: filters = {}
+        if groups is None: groups = []
+        query = _build_query(filters, groups)
+
+        els = self._connect_elasticsearch()
+        results = await els.search(index="meta", query=query, size=_PAGE_SIZE, from_=page*_PAGE_SIZE,
+                                   source_includes=_source_includes(fields))
+        return [doc["_source"] for doc in results["hits"]["hits"]]
+
+    async def find_page(self, filters: dict=None, groups: list=None, cursor: str=None, fields: list=None):
+        if filters is None: filters = {}
+        if groups is None: groups = []
+        query = _build_query(filters, groups)
+        els = self._connect_elasticsearch()
+
+        if cursor:
+            pit_id, search_after = _pit_cursor_state(cursor)
+        else:
+            pit_id = (await els.open_point_in_time(index="meta", keep_alive=_PIT_KEEP_ALIVE))["id"]
+            search_after = None
+
+        try:
+            results = await els.search(query=query, size=_PAGE_SIZE, sort=["_shard_doc"],
+                                       pit={"id": pit_id, "keep_alive": _PIT_KEEP_ALIVE},
+                                       search_after=search_after, source_includes=_source_includes(fields))
+        except NotFoundError as ex:
+            _raise_if_pit_missing(cursor, ex)
+            raise
+        pit_id = results.get("pit_id", pit_id)
+        hits = results["hits"]["hits"]
+
+        if len(hits) < _PAGE_SIZE:
+            await els.close_point_in_time(id=pit_id)
+            next_cursor = None
+        else:
+            next_cursor = encode_cursor({"pit": pit_id, "after": hits[-1]["sort"]})
+        return [doc["_source"] for doc in hits], next_cursor
+
+    async def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        if not doc_set_ids:
+            return {}
+        els = self._connect_elasticsearch()
+        results = await els.search(**_docset_count_search(doc_set_ids, filters, groups))
+        return _docset_counts(doc_set_ids, results)
+
+    async def notate(self, doc: dict) -> None:
+        try:
+            els = self._connect_elasticsearch()
+            await _ensure_index_async(els)
+            await els.create(index="meta", id=doc['docId'], document=doc)
+        except ConflictError as ex:
+            raise HTTPException(status_code=500,
+                                detail=f"Document {doc['docId']} already exists in repo!") from ex
+        except Exception as ex:
+            print(f"Notate failed: {ex}")
+            raise HTTPException(status_code=500,
+                                detail="Notate failed for unknown reason")
+
+    async def notate_many(self, docs: list) -> dict:
+        actions = [{"_op_type": "create", "_index": "meta", "_id": doc["docId"], "_source": doc}
+                   for doc in docs]
         try:
             els = self._connect_elasticsearch()
-            update = els.update(index="meta", id=doc_id, doc=update_fields, refresh=True)
+            await _ensure_index_async(els)
+            _, errors = await async_bulk(els, actions, raise_on_error=False)
+        except Exception as ex:
+            print(f"Notate failed: {ex}")
+            raise HTTPException(status_code=500,
+                                detail="Notate failed for unknown reason")
+        return _bulk_failures(errors)
+
+    async def get(self, doc_id: str, fields: list=None):
+        els = self._connect_elasticsearch()
+        try:
+            return (await els.get(index="meta", id=doc_id, source_includes=_source_includes(fields)))["_source"]
+        except NotFoundError:
+            return None
+
+    async def get_many(self, doc_ids: list, fields: list=None):
+        doc_ids = list(dict.fromkeys(doc_ids))
+        if not doc_ids:
+            return []
+        els = self._connect_elasticsearch()
+        res = await els.mget(index="meta", ids=doc_ids, source_includes=_source_includes(fields))
+        return [doc["_source"] for doc in res["docs"] if doc.get("found")]
+
+    async def update(self, doc_id: str, update_fields: dict, if_match: str=None) -> None:
+        els = self._connect_elasticsearch()
+        concurrency = {}
+        if if_match is not None:
+            try:
+                current = await els.get(index="meta", id=doc_id)
+            except NotFoundError as ex:
+                raise HTTPException(status_code=500,
+                                    detail=f"Document {doc_id} does not exist in repo!") from ex
+            check_etag(current["_source"], if_match)
+            concurrency = {"if_seq_no": current["_seq_no"], "if_primary_term": current["_primary_term"]}
+        try:
+            update = await els.update(index="meta", id=doc_id, doc=update_fields, refresh=True, **concurrency)
+        except ConflictError as ex:
+            raise HTTPException(status_code=412,
+                                detail="Document has been modified since it was read") from ex
         except Exception as ex:
-            print("Update failed: " + ex.message)
+            print(f"Update failed: {ex}")
             raise HTTPException(status_code=500,
                                 detail="Update failed for unknown reason")
 
@@ -1,80 +1,594 @@
+import bisect
 import configparser
+import copy
+import itertools
 import json
+import os
+import threading
 
 from fastapi import HTTPException
-from .RepositoryBase import RepoBase
+from .RepositoryBase import (AsyncRepoAdapter, RepoBase, check_etag, decode_cursor, encode_cursor,
+                             filter_conditions, filter_matches, prefix_upper_bound, project)
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows, where we can only protect against our own threads
+    fcntl = None
 
 config = configparser.ConfigParser()
 config.read('metarepo.conf')
 
-class LocalRepository(RepoBase):
-    
-    def _read_repo(self):
+# Maximum results returned by a single find, "page" offsets by multiples of this
+_PAGE_SIZE = 1000
+
+_FSYNC_POLICIES = ['always', 'interval', 'never']
+
+# The most metasheets AsyncLocalRepository.get_many will copy on the event loop, and the most
+# docSets its count_docsets will count there
+_IN_MEMORY_MAX_IDS = 20
+# The most docSet members AsyncLocalRepository.count_docsets will check on the event loop
+_IN_MEMORY_MAX_MEMBERS = 1000
+
+_stores = {} # filename -> _JournalStore, shared by every LocalRepository in the process
+_stores_lock = threading.Lock()
+
+
+def _members(val):
+    """ The indexable values in a field. A list, like docSetId, is indexed under each of its
+    members, once each """
+    if isinstance(val, list):
+        return dict.fromkeys(item for item in val if isinstance(item, (str, int, float, bool)))
+    if isinstance(val, (str, int, float, bool)):
+        return (val,)
+    return ()
+
+
+def _index_keys(metasheet):
+    """ Every (field, value) pair a metasheet can be looked up by. Top level values are indexed
+    under their own name, and metadata under "mType.key", matching the filter syntax """
+    for field, val in metasheet.items():
+        if isinstance(val, dict):
+            for key, sub_val in val.items():
+                for member in _members(sub_val):
+                    yield f"{field}.{key}", member
+        else:
+            for member in _members(val):
+                yield field, member
+
+
+def _sorted_kind(val):
+    """ Which sorted list a value's index key goes in, for range lookups. Bools count as numbers
+    here, since True and 1 share an index key. None for values with no order, like NaN """
+    if isinstance(val, str):
+        return "strings"
+    if isinstance(val, (int, float)) and val == val:
+        return "numbers"
+    return None
+
+
+def _is_legacy(data):
+    """ Whether a repo file is in the older single JSON dict format, rather than a journal. A
+    journal's first line is a whole record, unless that record was cut off, in which case the
+    file as a whole isn't JSON either """
+    for candidate in (data.split(b'\n', 1)[0], data):
+        try:
+            parsed = json.loads(candidate)
+        except ValueError:
+            continue
+        return not (isinstance(parsed, dict) and "op" in parsed)
+    return False
+
+
+def _get_field(metasheet, field):
+    """ Look up a filter field in a metasheet, returning (found, value) """
+    if field in metasheet:
+        return True, metasheet[field]
+    if '.' in field:
+        m_type, key = field.split('.', 1)
+        if isinstance(metasheet.get(m_type), dict) and key in metasheet[m_type]:
+            return True, metasheet[m_type][key]
+    return False, None
+
+
+class _JournalStore:
+    """
+    The repo file is an append-only journal with one JSON record per line, either
+    {"op": "notate", "doc": {...}} or {"op": "update", "docId": ..., "fields": {...}}.
+    It's replayed into memory on startup, along with an inverted index per field, so reads never
+    touch the disk. Writes take an exclusive lock on "<file>.lock", catch up on anything other
+    processes appended since we last looked, and then append a single record. A background thread
+    handles interval fsyncs and rewrites the journal as a snapshot once it's mostly superseded records.
+    """
+
+    def __init__(self, filename):
         config_field = "LOCAL"
-        filename = config.get(config_field, 'local_file', fallback="meta.repo")
+        self.filename = filename
+        self.fsync_policy = config.get(config_field, 'fsync', fallback='interval').lower()
+        if self.fsync_policy not in _FSYNC_POLICIES:
+            raise ValueError(f"Invalid LOCAL.fsync {self.fsync_policy}")
+        self.fsync_interval = config.getfloat(config_field, 'fsync_interval', fallback=1)
+        self.compact_ratio = config.getfloat(config_field, 'compact_ratio', fallback=2)
+        self.compact_min_records = config.getint(config_field, 'compact_min_records', fallback=1000)
+
+        self.lock = threading.RLock()
+        self.docs = {} # docId -> metasheet, in notate order
+        self.seq = {} # docId -> position in notate order, so index hits can be sorted cheaply
+        self.order = [] # docIds in notate order, for paging from a position
+        self.indexes = {} # field -> value -> set of docIds
+        self.sorted_keys = {} # field -> {"numbers": [...], "strings": [...]}, each index's values in order
+        self.records = 0 # Records in the journal, compared against len(docs) to decide on compaction
+        self.offset = 0 # How far into the journal we've replayed
+        self.inode = None # Compaction replaces the file, so this tells us when to replay from scratch
+        self.fout = None
+        self.dirty = False # Written but not yet fsynced
+        self.wakeup = threading.Event()
+
+        with self.file_lock():
+            self.catch_up()
+
+        worker = threading.Thread(target=self._background, daemon=True)
+        worker.start()
+
+    # LOCKING AND REPLAY
+
+    def file_lock(self):
+        return _FileLock(self)
+
+    def _reset(self):
+        self.docs = {}
+        self.seq = {}
+        self.order = []
+        self.indexes = {}
+        self.sorted_keys = {}
+        self.records = 0
+        self.offset = 0
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+
+    def catch_up(self):
+        """ Replay anything appended to the journal since we last read it. Call with the file lock held """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            open(self.filename, 'ab').close()
+            stat = os.stat(self.filename)
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self._reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return
+
         try:
-            with open(filename, 'r') as fin:
-                repo = json.load(fin)
-        except: # Either the file is bad or it's not json
+            with open(self.filename, 'rb') as fin:
+                fin.seek(self.offset)
+                data = fin.read()
+        except OSError as ex:
             raise HTTPException(status_code=500,
-                                detail=f"Could not read repo file {filename}")
-        return repo
-    
-    def _write_repo(self, repo):
-        config_field = "LOCAL"
-        filename = config.get(config_field, 'local_file', fallback="meta.repo")
+                                detail=f"Could not read repo file {self.filename}") from ex
+
+        if self.offset == 0 and _is_legacy(data):
+            self._load_legacy(data)
+            return
+
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            self._drop_torn_record(self.offset + end)
+        try:
+            for line in data[:end].splitlines():
+                if line.strip():
+                    self._apply(json.loads(line))
+        except (ValueError, KeyError) as ex:
+            raise HTTPException(status_code=500,
+                                detail=f"Could not read repo file {self.filename}") from ex
+        self.offset += end
+
+    def _drop_torn_record(self, size):
+        """ Writers append whole lines with the file lock held, so a partial last line is a record
+        whose write was cut off, by a crash for example. It was never acknowledged, so cut it off
+        the journal, and the next append starts on a fresh line """
+        print(f"Dropping a partly written record at the end of {self.filename}")
+        try:
+            os.truncate(self.filename, size)
+        except OSError as ex:
+            raise HTTPException(status_code=500,
+                                detail=f"Could not repair repo file {self.filename}") from ex
+
+    def is_current(self):
+        """ Whether our in-memory state already matches the journal on disk """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino == self.inode and stat.st_size == self.offset
+
+    def refresh(self):
+        """ Catch up for a read. Only takes the file lock if the journal changed on disk. Call with self.lock held """
+        if self.is_current():
+            return
+        with self.file_lock():
+            self.catch_up()
+
+    def _load_legacy(self, data):
+        """ Older repo files are a single JSON dict of docId -> metasheet. Load one, then
+        immediately rewrite it in the journal format """
+        try:
+            repo = json.loads(data)
+        except ValueError as ex: # Either the file is bad or it's not json
+            raise HTTPException(status_code=500,
+                                detail=f"Could not read repo file {self.filename}") from ex
+        for doc in repo.values():
+            self._apply({"op": "notate", "doc": doc})
+        self._compact()
+
+    def _apply(self, record):
+        """ Apply a single journal record to the in-memory state """
+        self.records += 1
+        if record["op"] == "notate":
+            doc = record["doc"]
+            doc_id = doc["docId"]
+            if doc_id in self.docs:
+                self._unindex(self.docs[doc_id])
+            else:
+                self.seq[doc_id] = len(self.order)
+                self.order.append(doc_id)
+            self.docs[doc_id] = doc
+            self._index(doc)
+        elif record["op"] == "update":
+            metasheet = self.docs[record["docId"]]
+            self._unindex(metasheet)
+            metasheet.update(record["fields"])
+            self._index(metasheet)
+
+    def _index(self, metasheet):
+        for field, val in _index_keys(metasheet):
+            values = self.indexes.setdefault(field, {})
+            if val not in values:
+                values[val] = set()
+                self._add_sorted_key(field, val)
+            values[val].add(metasheet["docId"])
+
+    def _unindex(self, metasheet):
+        for field, val in _index_keys(metasheet):
+            doc_ids = self.indexes[field][val]
+            doc_ids.discard(metasheet["docId"])
+            if not doc_ids:
+                del self.indexes[field][val]
+                self._remove_sorted_key(field, val)
+
+    # SORTED KEYS, for range and prefix lookups. Only built for a field once it's range queried,
+    # then kept up to date as values come and go
+
+    def _add_sorted_key(self, field, val):
+        kind = _sorted_kind(val)
+        if field in self.sorted_keys and kind is not None:
+            bisect.insort(self.sorted_keys[field][kind], val)
+
+    def _remove_sorted_key(self, field, val):
+        kind = _sorted_kind(val)
+        if field in self.sorted_keys and kind is not None:
+            keys = self.sorted_keys[field][kind]
+            idx = bisect.bisect_left(keys, val)
+            if idx < len(keys) and keys[idx] == val:
+                del keys[idx]
+
+    def _sorted(self, field, kind):
+        if field not in self.sorted_keys:
+            keys = {"numbers": [], "strings": []}
+            for val in self.indexes.get(field, {}):
+                val_kind = _sorted_kind(val)
+                if val_kind is not None:
+                    keys[val_kind].append(val)
+            keys["numbers"].sort()
+            keys["strings"].sort()
+            self.sorted_keys[field] = keys
+        return self.sorted_keys[field][kind]
+
+    def lookup(self, field, op, operand):
+        """ The docIds whose value for field might satisfy one filter condition, from the indexes """
+        values = self.indexes.get(field, {})
+        if op == "eq":
+            return values.get(operand, set())
+        if op == "in":
+            return set().union(*(values.get(item, set()) for item in operand))
+
+        keys = self._sorted(field, "strings" if isinstance(operand, str) else "numbers")
+        if op == "prefix":
+            low, high = bisect.bisect_left(keys, operand), len(keys)
+            upper = prefix_upper_bound(operand)
+            if upper is not None:
+                high = bisect.bisect_left(keys, upper)
+        else:
+            low, high = 0, len(keys)
+            if op == "gt":
+                low = bisect.bisect_right(keys, operand)
+            elif op == "gte":
+                low = bisect.bisect_left(keys, operand)
+            elif op == "lt":
+                high = bisect.bisect_left(keys, operand)
+            else: # lte
+                high = bisect.bisect_right(keys, operand)
+        return set().union(*(values[key] for key in keys[low:high]))
+
+    # WRITES
+
+    def append(self, record):
+        """ Append a record to the journal and apply it. Call with the file lock held, after catching up """
+        self.append_many([record])
+
+    def append_many(self, records):
+        """ Append several records with a single write. Call with the file lock held, after catching up """
+        lines = [(json.dumps(record) + '\n').encode('utf-8') for record in records]
+        data = b''.join(lines)
         try:
-            with open(filename, 'w') as fout:
-                json.dump(repo, fout)
-        except: # Either the file is bad or it's not json
+            if self.fout is None:
+                self.fout = open(self.filename, 'ab')
+            self.fout.write(data)
+            self.fout.flush()
+            if self.fsync_policy == 'always':
+                os.fsync(self.fout.fileno())
+            else:
+                self.dirty = True
+        except OSError as ex:
             raise HTTPException(status_code=500,
-                                detail=f"Could not write to repo file {filename}")
-
-    
-    def find(self, filters: dict=None, groups: list=None, page: int=0):
-        # Read json directly from a file
-        repo = self._read_repo()
-                    
-        # Run through each metasheet found. If it matches the filters, we're good
-        results = []
-        for doc_id in repo:
-            metasheet = repo[doc_id]
+                                detail=f"Could not write to repo file {self.filename}") from ex
+        self.offset += len(data)
+        for line in lines:
+            self._apply(json.loads(line)) # Keep our own copy, exactly as it'll be replayed
+
+        if self._should_compact():
+            self.wakeup.set()
+
+    def _should_compact(self):
+        return (self.records > self.compact_min_records and
+                self.records > self.compact_ratio * len(self.docs))
+
+    def _compact(self):
+        """ Replace the journal with one notate record per live doc. Call with the file lock held """
+        tmp_filename = self.filename + '.compact'
+        with open(tmp_filename, 'wb') as fout:
+            for doc in self.docs.values():
+                fout.write((json.dumps({"op": "notate", "doc": doc}) + '\n').encode('utf-8'))
+            fout.flush()
+            os.fsync(fout.fileno())
+            size = fout.tell()
+        os.replace(tmp_filename, self.filename)
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+        self.inode = os.stat(self.filename).st_ino
+        self.offset = size
+        self.records = len(self.docs)
+        self.dirty = False
+
+    def _background(self):
+        """ Interval fsyncs and compaction, off the request path """
+        while True:
+            self.wakeup.wait(self.fsync_interval)
+            self.wakeup.clear()
+            try:
+                with self.file_lock():
+                    if self.dirty and self.fsync_policy == 'interval' and self.fout is not None:
+                        os.fsync(self.fout.fileno())
+                        self.dirty = False
+                    if self._should_compact():
+                        self.catch_up()
+                        self._compact()
+            except Exception as ex: # Never let the worker die, we'll just try again next round
+                print(f"Local repo maintenance failed: {ex}")
+
+
+class _FileLock:
+    """ Exclusive access to a journal, across both threads and processes """
+
+    def __init__(self, store):
+        self.store = store
+        self.lock_file = None
+
+    def __enter__(self):
+        self.store.lock.acquire()
+        if fcntl is not None:
+            self.lock_file = open(self.store.filename + '.lock', 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self.store
+
+    def __exit__(self, *exc):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+        self.store.lock.release()
+
+
+def _store_filename():
+    config_field = "LOCAL"
+    return config.get(config_field, 'local_file', fallback="meta.repo")
+
+
+def _get_store():
+    filename = _store_filename()
+    with _stores_lock:
+        if filename not in _stores:
+            _stores[filename] = _JournalStore(filename)
+        return _stores[filename]
+
+
+class LocalRepository(RepoBase):
+
+    def _match(self, store, filters, groups, start=0):
+        """ Yield the metasheets matching every filter, in notate order, from position start on.
+        Call with store.lock held """
+        # Narrow down candidates with the indexes, starting from the most selective filter.
+        # Every filter is still checked against each candidate below
+        conditions = {_filter: filter_conditions(val) for _filter, val in filters.items()}
+        indexed = [store.lookup(_filter, op, operand)
+                   for _filter, parts in conditions.items() for op, operand in parts]
+        candidates = None
+        for matches in sorted(indexed, key=len):
+            candidates = set(matches) if candidates is None else candidates & matches
+            if not candidates:
+                return
+        if candidates is None:
+            doc_ids = (store.order[idx] for idx in range(start, len(store.order)))
+        else:
+            doc_ids = sorted((doc_id for doc_id in candidates if store.seq[doc_id] >= start),
+                             key=store.seq.get)
+
+        # Run through each candidate. If it matches the filters, we're good
+        for doc_id in doc_ids:
+            metasheet = store.docs[doc_id]
             valid = True
-            for _filter in filters:
-                if _filter not in metasheet or not filters[_filter] == metasheet[_filter]:
+            for _filter, parts in conditions.items():
+                found, val = _get_field(metasheet, _filter)
+                if not found or not filter_matches(val, parts):
                     valid = False
-                    continue
-            if groups and metasheet['siteMetadata']['tenant'] not in groups:
+                    break
+            if groups and metasheet.get('siteMetadata', {}).get('tenant') not in groups:
                 valid = False
             if valid:
-                results.append(metasheet)
-                
-        return results
-        
-    
+                yield metasheet
+
+    def find(self, filters: dict=None, groups: list=None, page: int=0, fields: list=None):
+        if filters is None: filters = {}
+        store = _get_store()
+
+        with store.lock:
+            store.refresh()
+            results = list(itertools.islice(self._match(store, filters, groups),
+                                            page*_PAGE_SIZE, (page+1)*_PAGE_SIZE))
+            # Hand back copies so callers can't modify what's in memory. Project first, so
+            # archives that weren't asked for are never copied
+            return copy.deepcopy([project(result, fields) for result in results])
+
+    def get(self, doc_id: str, fields: list=None):
+        store = _get_store()
+
+        with store.lock:
+            store.refresh()
+            return self._get_many(store, [doc_id], fields)[0] if doc_id in store.docs else None
+
+    def get_many(self, doc_ids: list, fields: list=None):
+        store = _get_store()
+
+        with store.lock:
+            store.refresh()
+            return self._get_many(store, doc_ids, fields)
+
+    def _get_many(self, store, doc_ids, fields=None):
+        """ Call with store.lock held, after refreshing """
+        metasheets = [project(store.docs[doc_id], fields)
+                      for doc_id in dict.fromkeys(doc_ids) if doc_id in store.docs]
+        return copy.deepcopy(metasheets)
+
+    def find_page(self, filters: dict=None, groups: list=None, cursor: str=None, fields: list=None):
+        if filters is None: filters = {}
+        start = decode_cursor(cursor).get("position", 0) if cursor else 0
+        store = _get_store()
+
+        with store.lock:
+            store.refresh()
+            results = list(itertools.islice(self._match(store, filters, groups, start), _PAGE_SIZE))
+            next_cursor = None
+            if len(results) == _PAGE_SIZE:
+                next_cursor = encode_cursor({"position": store.seq[results[-1]["docId"]] + 1})
+            return copy.deepcopy([project(result, fields) for result in results]), next_cursor
+
+    def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        """ Counted straight off the docSetId index, without copying any metasheets """
+        store = _get_store()
+
+        with store.lock:
+            store.refresh()
+            return self._count_docsets(store, doc_set_ids, filters, groups)
+
+    def _count_docsets(self, store, doc_set_ids, filters, groups):
+        """ Call with store.lock held, after refreshing """
+        return {doc_set_id: sum(1 for _ in self._match(store, dict(filters or {}, docSetId=doc_set_id), groups))
+                for doc_set_id in dict.fromkeys(doc_set_ids)}
+
     def notate(self, doc: dict) -> None:
-        repo = self._read_repo()
-            
-        doc_id = doc['docId']
-        if doc_id in repo:
-            raise HTTPException(status_code=500,
-                                detail=f"Document {doc_id} already exists in repo!")
-       
-        repo[doc_id] = doc
-        
-        self._write_repo(repo)
+        store = _get_store()
 
-    def update(self, doc_id: str, update_fields: dict) -> None:
-        repo = self._read_repo()
+        with store.file_lock():
+            store.catch_up()
+            doc_id = doc['docId']
+            if doc_id in store.docs:
+                raise HTTPException(status_code=500,
+                                    detail=f"Document {doc_id} already exists in repo!")
+            store.append({"op": "notate", "doc": doc})
 
-        if doc_id not in repo:
-            raise HTTPException(status_code=500,
-                                detail=f"Document {doc_id} does not exist in repo!")
-            
-        metasheet = repo[doc_id]
-        for field in update_fields:
-            metasheet[field] = update_fields[field]
-        repo[doc_id] = metasheet
-
-        self._write_repo(repo)
-    
\ No newline at end of file
+    def notate_many(self, docs: list) -> None:
+        """ One lock, one catch up and one append for the whole batch """
+        store = _get_store()
+
+        with store.file_lock():
+            store.catch_up()
+            doc_ids = set()
+            for doc in docs:
+                doc_id = doc['docId']
+                if doc_id in store.docs or doc_id in doc_ids:
+                    raise HTTPException(status_code=500,
+                                        detail=f"Document {doc_id} already exists in repo!")
+                doc_ids.add(doc_id)
+            store.append_many([{"op": "notate", "doc": doc} for doc in docs])
+
+    def update(self, doc_id: str, update_fields: dict, if_match: str=None) -> None:
+        store = _get_store()
+
+        with store.file_lock():
+            store.catch_up()
+            if doc_id not in store.docs:
+                raise HTTPException(status_code=500,
+                                    detail=f"Document {doc_id} does not exist in repo!")
+            check_etag(store.docs[doc_id], if_match)
+            store.append({"op": "update", "docId": doc_id, "fields": update_fields})
+
+
+class AsyncLocalRepository(AsyncRepoAdapter):
+    """ Small reads (gets and counts of small docSets) are served straight from memory, on the event
+    loop, when the store's lock is free and the journal hasn't changed on disk. The lock is only
+    tried, never waited on, since writers and the background thread hold it across disk I/O. Anything
+    else, including finds, which copy up to a page of metasheets, is run in the threadpool """
+    repo_class = LocalRepository
+
+    def _try_in_memory(self, func, *args):
+        """ Run func(store, *args) without blocking, returning (True, result), or (False, None) if
+        that would mean waiting on the lock or reading the disk """
+        store = _stores.get(_store_filename())
+        if store is None or not store.lock.acquire(blocking=False):
+            return False, None
+        try:
+            if not store.is_current():
+                return False, None
+            return True, func(store, *args)
+        finally:
+            store.lock.release()
+
+    async def get(self, doc_id: str, fields: list=None):
+        served, metasheets = self._try_in_memory(self.repo._get_many, # pylint: disable=protected-access
+                                                 [doc_id], fields)
+        if served:
+            return metasheets[0] if metasheets else None
+        return await super().get(doc_id, fields)
+
+    async def get_many(self, doc_ids: list, fields: list=None):
+        if len(doc_ids) <= _IN_MEMORY_MAX_IDS:
+            served, metasheets = self._try_in_memory(self.repo._get_many, # pylint: disable=protected-access
+                                                     doc_ids, fields)
+            if served:
+                return metasheets
+        return await super().get_many(doc_ids, fields)
+
+    def _count_small_docsets(self, store, doc_set_ids, filters, groups):
+        """ Count as LocalRepository does, or return None if the docSets have too many members to
+        check on the event loop """
+        members = sum(len(store.lookup("docSetId", "eq", doc_set_id)) for doc_set_id in set(doc_set_ids))
+        if members > _IN_MEMORY_MAX_MEMBERS:
+            return None
+        return self.repo._count_docsets(store, doc_set_ids, filters, groups) # pylint: disable=protected-access
+
+    async def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        if len(doc_set_ids) <= _IN_MEMORY_MAX_IDS:
+            served, counts = self._try_in_memory(self._count_small_docsets, doc_set_ids, filters, groups)
+            if served and counts is not None:
+                return counts
+        return await super().count_docsets(doc_set_ids, filters, groups)
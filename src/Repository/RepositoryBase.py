@@ -1,25 +1,355 @@
+import base64
+import functools
+import hashlib
+import json
+import operator
 from abc import ABC, abstractmethod
 
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+
+def encode_cursor(state: dict) -> str:
+    """ Turn a repo's paging state into an opaque token for the client """
+    return base64.urlsafe_b64encode(json.dumps(state).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> dict:
+    """ The reverse of encode_cursor. A token we didn't hand out is the client's mistake """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    if not isinstance(state, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return state
+
+
+ARCHIVE_FIELDS = ["frameworkArchive", "metadataArchive", "targetMetadataArchive", "siteMetadataArchive"]
+
+def project(metasheet: dict, fields: list) -> dict:
+    """ Cut a metasheet down to the requested fields. A field is either top level, like
+    "displayName", or a single metadata key, like "targetMetadata.filePath". docId is always kept.
+    If fields is None the metasheet is returned whole """
+    if fields is None:
+        return metasheet
+    projected = {"docId": metasheet["docId"]}
+    for field in fields:
+        if '.' in field:
+            parent, key = field.split('.', 1)
+            sub = metasheet.get(parent)
+            if isinstance(sub, dict) and key in sub:
+                projected.setdefault(parent, {})[key] = sub[key]
+        elif field in metasheet:
+            projected[field] = metasheet[field]
+    return projected
+
+def wants_field(fields: list, field: str) -> bool:
+    """ Whether a projection needs any part of a top level field """
+    return fields is None or any(want == field or want.startswith(field + '.') for want in fields)
+
+def _with_fields(func, fields):
+    """ Only pass fields along when there are some, so repos written before projection still work """
+    return func if fields is None else functools.partial(func, fields=fields)
+
+
+# Besides a plain value for equality, a filter can map a field to operators, like {"gte": 5, "lt": 10}
+_RANGE_OPERATORS = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+FILTER_OPERATORS = list(_RANGE_OPERATORS) + ["in", "prefix"]
+_FILTER_VALUE_TYPES = (str, int, float)
+
+def filter_conditions(val) -> list:
+    """ Split a filter value into (operator, operand) pairs, all of which must hold. A plain value
+    is ("eq", value). Range operands are numbers, which only match numbers, or strings, which only
+    match strings, compared lexicographically (so ISO 8601 times work). "in" takes a list of plain
+    values and "prefix" a string """
+    if isinstance(val, _FILTER_VALUE_TYPES):
+        return [("eq", val)]
+    if not isinstance(val, dict) or not val:
+        raise HTTPException(status_code=400,
+                            detail="filters field must map a string to a string, int, float, "
+                                   f"or a dict of operators ({', '.join(FILTER_OPERATORS)})")
+    conditions = []
+    for op, operand in val.items():
+        if op in _RANGE_OPERATORS:
+            valid = isinstance(operand, _FILTER_VALUE_TYPES) and not isinstance(operand, bool)
+        elif op == "in":
+            valid = isinstance(operand, list) and all(isinstance(item, _FILTER_VALUE_TYPES) for item in operand)
+        elif op == "prefix":
+            valid = isinstance(operand, str)
+        else:
+            raise HTTPException(status_code=400,
+                                detail=f"Unknown filter operator {op}, expected one of {', '.join(FILTER_OPERATORS)}")
+        if not valid:
+            raise HTTPException(status_code=400, detail=f"Invalid operand for filter operator {op}")
+        conditions.append((op, operand))
+    return conditions
+
+def range_comparable(value, operand) -> bool:
+    """ Whether a range operator can compare a stored value against an operand """
+    if isinstance(operand, str):
+        return isinstance(value, str)
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _same_value(value, operand) -> bool:
+    """ Equality that keeps types apart, so 1 doesn't match True. 1 still matches 1.0 """
+    return value == operand and isinstance(value, bool) == isinstance(operand, bool)
+
+def filter_matches(value, conditions: list) -> bool:
+    """ Check a stored value against the conditions from filter_conditions. A list, like docSetId,
+    matches if any of its members does """
+    if isinstance(value, list):
+        return any(filter_matches(item, conditions) for item in value)
+    for op, operand in conditions:
+        if op == "eq":
+            matched = _same_value(value, operand)
+        elif op == "in":
+            matched = any(_same_value(value, item) for item in operand)
+        elif op == "prefix":
+            matched = isinstance(value, str) and value.startswith(operand)
+        else:
+            matched = range_comparable(value, operand) and _RANGE_OPERATORS[op](value, operand)
+        if not matched:
+            return False
+    return True
+
+def prefix_upper_bound(prefix: str):
+    """ The smallest string greater than every string starting with prefix, so a prefix can be
+    looked up as the range prefix <= value < bound. None if there's no such string """
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    next_char = ord(prefix[-1]) + 1
+    if 0xD800 <= next_char <= 0xDFFF: # Surrogates can't be encoded, skip past them
+        next_char = 0xE000
+    return prefix[:-1] + chr(next_char)
+
+
+def metasheet_etag(metasheet: dict) -> str:
+    """ A version tag for a metasheet, which changes whenever anything in it does """
+    encoded = json.dumps(metasheet, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+def check_etag(metasheet: dict, if_match: str) -> None:
+    """ Raise a 412 if a metasheet isn't the version the caller expects """
+    if if_match is not None and metasheet_etag(metasheet) != if_match:
+        raise HTTPException(status_code=412,
+                            detail="Document has been modified since it was read")
+
+
 class RepoBase(ABC):
     
     @abstractmethod
-    def find(self, filters: dict=None, groups: list=None, page: int=0):
-        """A find should do a hard match on every filter
+    def find(self, filters: dict=None, groups: list=None, page: int=0, fields: list=None):
+        """A find should do a hard match on every filter. A filter's value is either a plain value
+        to match exactly, or a dict of operators (see filter_conditions)
         If groups are provided, we should match one
         page allows for pagination if we're doing multiple searches
+        fields, if given, limits each result to those fields (see project). Anything not asked for,
+        especially the archives, shouldn't be read at all if the repo can avoid it
         
         Return a list of db results. This should JUST be the notation we care about, no db metadata"""
         pass
     
+    def get(self, doc_id: str, fields: list=None):
+        """ Fetch a single document by docId, or None if it doesn't exist. No group or status checks.
+        If fields is given, the document is cut down to them as in find.
+        By default this is a find on docId, repos should override it with a primary key lookup """
+        results = _with_fields(self.find, fields)({"docId": doc_id})
+        return results[0] if results else None
+
+    def get_many(self, doc_ids: list, fields: list=None):
+        """ Fetch several documents by docId in one call. Returns the ones that exist, in the order
+        asked for, with duplicates dropped. No group or status checks.
+        By default this calls get once per docId, repos should override it with a batched lookup """
+        metasheets = []
+        for doc_id in dict.fromkeys(doc_ids):
+            metasheet = _with_fields(self.get, fields)(doc_id)
+            if metasheet is not None:
+                metasheets.append(metasheet)
+        return metasheets
+
+    def find_page(self, filters: dict=None, groups: list=None, cursor: str=None, fields: list=None):
+        """ Like find, but paged with an opaque continuation token rather than a page number, so
+        scanning the whole repo stays linear. cursor is None for the first page, and afterwards
+        whatever the previous call returned.
+
+        Return a tuple of (list of db results, next cursor). The next cursor is None once there's nothing left.
+        By default this just wraps find's page numbers, repos should override it if they can do better """
+        page = decode_cursor(cursor).get("page", 0) if cursor else 0
+        results = _with_fields(self.find, fields)(filters, groups, page)
+        if not results:
+            return results, None
+        return results, encode_cursor({"page": page + 1})
+
+    def validate(self, filters: dict=None, groups: list=None) -> None:
+        """ Raise an HTTPException if find would reject these filters and groups, without searching.
+        Streamed finds call this first, since nothing can be raised once a response has started.
+        By default it accepts everything, repos that refuse some filters should override it """
+        pass
+
+    def iter_find(self, filters: dict=None, groups: list=None, fields: list=None):
+        """ Like find, but a generator over every match instead of a single page, so results can be
+        streamed out with bounded memory. By default this walks find_page, a page at a time """
+        cursor = None
+        while True:
+            results, cursor = _with_fields(self.find_page, fields)(filters, groups, cursor)
+            yield from results
+            if cursor is None:
+                return
+
+    def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        """ The number of documents in each docSet, as {docSetId: count}, counting only documents
+        that also match filters and groups. By default this walks iter_find for each docSet, repos
+        should override it with a count that doesn't read the documents """
+        counts = {}
+        for doc_set_id in dict.fromkeys(doc_set_ids):
+            members = self.iter_find(dict(filters or {}, docSetId=doc_set_id), groups, fields=["docId"])
+            counts[doc_set_id] = sum(1 for _ in members)
+        return counts
+
     @abstractmethod
     def notate(self, doc: dict) -> None:
         """ Add a document to the repo. Note that validation must be done beforehand """
         pass
 
+    def notate_many(self, docs: list) -> dict:
+        """ Add several documents to the repo. Validation must be done beforehand.
+        By default this notates them one at a time, repos should override it with a bulk write.
+        A repo whose bulk write can fail for some items while storing the rest returns those
+        items as {docId: HTTPException}. One that stores all or nothing returns None or raises """
+        for doc in docs:
+            self.notate(doc)
+
+    def restore_many(self, docs: list) -> None:
+        """ Add whole documents copied from another repo, archives included, as in tools/copy_repo.py.
+        Repos that store documents as they are can just notate them, which is the default.
+        Repos that build archives from their own history should rebuild that history instead """
+        self.notate_many(docs)
+
     @abstractmethod
-    def update(self, doc_id: str, update_fields: dict) -> None:
+    def update(self, doc_id: str, update_fields: dict, if_match: str=None) -> None:
         """ Update a preexisting document.
         doc_id is the document to be updated
-        update_fields is a dict of values to be updated. Any key not included in this parameter will not be updated """
+        update_fields is a dict of values to be updated. Any key not included in this parameter will not be updated
+        if_match, if given, is the metasheet_etag the document must still have. Otherwise raise a 412 without updating """
+        pass
+
+    @classmethod
+    def close(cls) -> None:
+        """ Release anything held for the life of the process, like connections. Called on app shutdown """
         pass
-    
\ No newline at end of file
+    
+
+class AsyncRepoBase(ABC):
+    """ The async counterpart to RepoBase, used by the async endpoints so that waiting on the
+    database doesn't hold a worker thread. Each method behaves exactly like its RepoBase version.
+    A repo opts in by defining Async<repotype> in its module, otherwise the sync repo is wrapped in
+    an AsyncRepoAdapter """
+
+    @abstractmethod
+    async def find(self, filters: dict=None, groups: list=None, page: int=0, fields: list=None):
+        pass
+
+    @abstractmethod
+    async def find_page(self, filters: dict=None, groups: list=None, cursor: str=None, fields: list=None):
+        pass
+
+    async def get(self, doc_id: str, fields: list=None):
+        results = await _with_fields(self.find, fields)({"docId": doc_id})
+        return results[0] if results else None
+
+    async def get_many(self, doc_ids: list, fields: list=None):
+        metasheets = []
+        for doc_id in dict.fromkeys(doc_ids):
+            metasheet = await _with_fields(self.get, fields)(doc_id)
+            if metasheet is not None:
+                metasheets.append(metasheet)
+        return metasheets
+
+    def validate(self, filters: dict=None, groups: list=None) -> None:
+        """ Not async, since it only checks the filters. See RepoBase.validate """
+        pass
+
+    async def iter_find(self, filters: dict=None, groups: list=None, fields: list=None):
+        """ An async generator over every match. By default this walks find_page, a page at a time """
+        cursor = None
+        while True:
+            results, cursor = await _with_fields(self.find_page, fields)(filters, groups, cursor)
+            for result in results:
+                yield result
+            if cursor is None:
+                return
+
+    async def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        counts = {}
+        for doc_set_id in dict.fromkeys(doc_set_ids):
+            counts[doc_set_id] = 0
+            async for _ in self.iter_find(dict(filters or {}, docSetId=doc_set_id), groups, fields=["docId"]):
+                counts[doc_set_id] += 1
+        return counts
+
+    @abstractmethod
+    async def notate(self, doc: dict) -> None:
+        pass
+
+    async def notate_many(self, docs: list) -> dict:
+        for doc in docs:
+            await self.notate(doc)
+
+    @abstractmethod
+    async def update(self, doc_id: str, update_fields: dict, if_match: str=None) -> None:
+        pass
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """ Release anything held for the life of the process. Called on app shutdown """
+        pass
+
+
+class AsyncRepoAdapter(AsyncRepoBase):
+    """ Runs a sync repo's methods in a threadpool, for repos without a native async version.
+    repo_class is the RepoBase subclass to wrap. If call_wrapper is set, each call is passed
+    through it before going to the threadpool, and what it returns is run instead. MetaRepo uses
+    this to follow profiled requests into the threadpool """
+    repo_class = None
+    call_wrapper = None
+
+    def __init__(self):
+        self.repo = self.repo_class()
+
+    async def _run(self, func, *args):
+        if self.call_wrapper is not None:
+            func = self.call_wrapper(func)
+        return await self._run_in_thread(func, *args)
+
+    async def _run_in_thread(self, func, *args):
+        return await run_in_threadpool(func, *args)
+
+    async def find(self, filters: dict=None, groups: list=None, page: int=0, fields: list=None):
+        return await self._run(_with_fields(self.repo.find, fields), filters, groups, page)
+
+    async def find_page(self, filters: dict=None, groups: list=None, cursor: str=None, fields: list=None):
+        return await self._run(_with_fields(self.repo.find_page, fields), filters, groups, cursor)
+
+    def validate(self, filters: dict=None, groups: list=None) -> None:
+        self.repo.validate(filters, groups)
+
+    async def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        return await self._run(self.repo.count_docsets, doc_set_ids, filters, groups)
+
+    async def notate(self, doc: dict) -> None:
+        return await self._run(self.repo.notate, doc)
+
+    async def notate_many(self, docs: list) -> dict:
+        return await self._run(self.repo.notate_many, docs)
+
+    async def get(self, doc_id: str, fields: list=None):
+        return await self._run(_with_fields(self.repo.get, fields), doc_id)
+
+    async def get_many(self, doc_ids: list, fields: list=None):
+        return await self._run(_with_fields(self.repo.get_many, fields), doc_ids)
+
+    async def update(self, doc_id: str, update_fields: dict, if_match: str=None) -> None:
+        if if_match is None: # Custom repos written before if_match existed won't take it
+            return await self._run(self.repo.update, doc_id, update_fields)
+        return await self._run(functools.partial(self.repo.update, if_match=if_match), doc_id, update_fields)
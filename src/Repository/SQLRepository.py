@@ -1,57 +1,399 @@
+import asyncio
+import atexit
 import configparser
+import functools
+import json
+import math
 import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from fastapi import HTTPException
 
-from .RepositoryBase import RepoBase
+from .RepositoryBase import (ARCHIVE_FIELDS, AsyncRepoAdapter, RepoBase, check_etag, decode_cursor,
+                             encode_cursor, filter_conditions, prefix_upper_bound, project, wants_field)
 
 config = configparser.ConfigParser()
 config.read('metarepo.conf')
 
+# Connections are kept open and reused, one per thread, since sqlite connections shouldn't be
+# shared across threads mid-transaction. The schema only needs to be checked once per process
+_local = threading.local() # .connection is this thread's connection
+_connections = {} # connection -> the thread it belongs to, so they can be closed when it exits
+_connections_lock = threading.Lock()
+_schema_ready = set() # db filenames whose tables have been created this process
+
+_JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+_SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+# How many docIds go in a single IN (...) when hydrating. Older sqlite builds cap bound
+# parameters at 999, so stay under that
+_HYDRATE_CHUNK_SIZE = 500
+
+# Maximum results returned by a single find, "page" offsets by multiples of this
+_PAGE_SIZE = 1000
+
+_METADATA_TYPES = ['userMetadata', 'siteMetadata', 'targetMetadata']
+# Metasheet fields in the order of the Metasheets/CurrentMetasheets columns
+_METASHEET_COLUMNS = ["docId", "timestamp", "displayName", "targetClass", "siteClass", "status"]
+# Filterable framework fields, and the Metasheets column each one is stored in
+_FRAMEWORK_COLUMNS = {"docId": "docID", "timestamp": "timestamp", "displayName": "displayName",
+                      "targetClass": "targetClass", "siteClass": "siteClass", "status": "status"}
+
+
+def _encode_value(val):
+    """ Metadata values are stored as text in val, with their type in vtype so they read back the
+    same. Numbers are also stored in num, so range filters on them can use an index.
+    Returns (val, num, vtype) """
+    if isinstance(val, bool):
+        return str(val), None, "bool"
+    if isinstance(val, int):
+        return str(val), val, "int"
+    if isinstance(val, float):
+        return str(val), val, "float"
+    if isinstance(val, str):
+        return val, None, "str"
+    return json.dumps(val), None, "json"
+
+def _decode_value(val, vtype):
+    """ The reverse of _encode_value. Rows written before values were typed have no vtype, and
+    stay strings """
+    if vtype == "int":
+        return int(val)
+    if vtype == "float":
+        return float(val)
+    if vtype == "bool":
+        return val == "True"
+    if vtype == "json":
+        return json.loads(val)
+    return val
+
+# CurrentMetadata rows holding strings. Rows from before values were typed count as strings, and
+# the ones that look like numbers count as numbers too, through num
+_STRING_ROWS = "(vtype IS NULL OR vtype = 'str')"
+
+def _typed_equals(operands):
+    """ A CurrentMetadata condition matching any of operands with its type, so 5 matches 5 and
+    5.0 but not "5" or True. Numbers compare on num, so they use the (type, key, num) index.
+    Returns (clause, params) """
+    strings = [item for item in operands if isinstance(item, str)]
+    bools = [str(item) for item in operands if isinstance(item, bool)]
+    numbers = [item for item in operands if not isinstance(item, (str, bool))]
+    parts = []
+    params = []
+    if strings:
+        parts.append(f"(val IN ({','.join('?' * len(strings))}) AND {_STRING_ROWS})")
+        params.extend(strings)
+    if numbers:
+        parts.append(f"num IN ({','.join('?' * len(numbers))})")
+        params.extend(numbers)
+    if bools:
+        parts.append(f"(val IN ({','.join('?' * len(bools))}) AND vtype = 'bool')")
+        params.extend(bools)
+    return "(" + " OR ".join(parts) + ")", params
+
+def _parse_number(val):
+    """ A string's value as a number, or None if it isn't one """
+    try:
+        num = float(val)
+    except (TypeError, ValueError):
+        return None
+    return num if math.isfinite(num) else None
+
+def _backfill_numbers(cur):
+    """ Metadata written before values were typed was stored as strings. Give the ones that look
+    like numbers a num as well, so range filters still find them """
+    rows = cur.execute("SELECT rowid, val FROM CurrentMetadata WHERE vtype IS NULL").fetchall()
+    numbers = [(_parse_number(val), rowid) for rowid, val in rows]
+    cur.executemany("UPDATE CurrentMetadata SET num = ? WHERE rowid = ?",
+                    [(num, rowid) for num, rowid in numbers if num is not None])
+
+
+def _create_schema(con):
+    """ Create our tables if they don't exist yet, then bring the schema up to date """
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS
+                Metasheets (docID CHAR, timestamp INT, displayName CHAR, targetClass CHAR, siteClass CHAR, status INT,
+                            PRIMARY KEY (docID, timestamp))
+                """)
+    cur.execute("""CREATE TABLE IF NOT EXISTS
+                Metadata (docID CHAR, timestamp INT, key CHAR, val CHAR, type CHAR,
+                          PRIMARY KEY (docID, timestamp, key, type),
+                          FOREIGN KEY(docID) REFERENCES Metasheets(docID))
+                """)
+    cur.execute("""CREATE TABLE IF NOT EXISTS
+                DocSets (docID CHAR, timestamp INT, docSetId CHAR,
+                         FOREIGN KEY(docID) REFERENCES Metasheets(docID))
+                """)
+    con.commit() # Save new tables, if they were created
+    _migrate(con)
+
+
+# Schema changes after the original three tables. Each entry is (version, statements), and the
+# database's PRAGMA user_version records the last one applied, so existing .db files pick up
+# new changes on startup. A statement can also be a function taking a cursor, for changes SQL
+# can't express. Only ever append to this list--never edit an entry that's shipped
+_MIGRATIONS = [
+    (1, [
+        # Filters on userMetadata.foo style keys, covering so the docID comes straight off the index
+        "CREATE INDEX IF NOT EXISTS Metadata_type_key_val ON Metadata (type, key, val, docID)",
+        # Docset membership lookups, in both directions
+        "CREATE INDEX IF NOT EXISTS DocSets_docSetId ON DocSets (docSetId, docID)",
+        "CREATE INDEX IF NOT EXISTS DocSets_docID ON DocSets (docID, timestamp)",
+        # Framework level filters
+        "CREATE INDEX IF NOT EXISTS Metasheets_status ON Metasheets (status, docID)",
+        "CREATE INDEX IF NOT EXISTS Metasheets_targetClass ON Metasheets (targetClass, docID)",
+        "CREATE INDEX IF NOT EXISTS Metasheets_siteClass ON Metasheets (siteClass, docID)",
+    ]),
+    (2, [
+        # Materialized current state, one row per docId (or per key/docset). Searches and reads
+        # only touch these, the original three tables become history for the archives
+        """CREATE TABLE IF NOT EXISTS
+           CurrentMetasheets (docID CHAR PRIMARY KEY, timestamp INT, displayName CHAR, targetClass CHAR,
+                              siteClass CHAR, status INT)""",
+        """CREATE TABLE IF NOT EXISTS
+           CurrentMetadata (docID CHAR, key CHAR, val CHAR, type CHAR,
+                            PRIMARY KEY (docID, type, key),
+                            FOREIGN KEY(docID) REFERENCES CurrentMetasheets(docID))""",
+        """CREATE TABLE IF NOT EXISTS
+           CurrentDocSets (docID CHAR, docSetId CHAR,
+                           FOREIGN KEY(docID) REFERENCES CurrentMetasheets(docID))""",
+        "CREATE INDEX IF NOT EXISTS CurrentMetadata_type_key_val ON CurrentMetadata (type, key, val, docID)",
+        "CREATE INDEX IF NOT EXISTS CurrentDocSets_docSetId ON CurrentDocSets (docSetId, docID)",
+        "CREATE INDEX IF NOT EXISTS CurrentDocSets_docID ON CurrentDocSets (docID)",
+        "CREATE INDEX IF NOT EXISTS CurrentMetasheets_status ON CurrentMetasheets (status, docID)",
+        "CREATE INDEX IF NOT EXISTS CurrentMetasheets_targetClass ON CurrentMetasheets (targetClass, docID)",
+        "CREATE INDEX IF NOT EXISTS CurrentMetasheets_siteClass ON CurrentMetasheets (siteClass, docID)",
+        # Backfill from history. Every notate writes the whole doc under one timestamp, so the
+        # current state is whatever was written at each docID's latest timestamp
+        """INSERT OR REPLACE INTO CurrentMetasheets
+           SELECT docID, MAX(timestamp), displayName, targetClass, siteClass, status
+           FROM Metasheets GROUP BY docID""",
+        """INSERT OR REPLACE INTO CurrentMetadata
+           SELECT md.docID, md.key, md.val, md.type FROM Metadata md
+           JOIN CurrentMetasheets cm ON cm.docID = md.docID AND cm.timestamp = md.timestamp""",
+        """INSERT INTO CurrentDocSets
+           SELECT ds.docID, ds.docSetId FROM DocSets ds
+           JOIN CurrentMetasheets cm ON cm.docID = ds.docID AND cm.timestamp = ds.timestamp
+           ORDER BY ds.rowid""",
+    ]),
+    (3, [
+        # Typed metadata values (see _encode_value). val keeps the text, so equality and prefix
+        # filters work as before, and num holds numbers for range filters
+        "ALTER TABLE Metadata ADD COLUMN num REAL",
+        "ALTER TABLE Metadata ADD COLUMN vtype CHAR",
+        "ALTER TABLE CurrentMetadata ADD COLUMN num REAL",
+        "ALTER TABLE CurrentMetadata ADD COLUMN vtype CHAR",
+        "CREATE INDEX IF NOT EXISTS CurrentMetadata_type_key_num ON CurrentMetadata (type, key, num, docID)",
+        "CREATE INDEX IF NOT EXISTS CurrentMetasheets_timestamp ON CurrentMetasheets (timestamp, docID)",
+        "CREATE INDEX IF NOT EXISTS CurrentMetasheets_displayName ON CurrentMetasheets (displayName, docID)",
+        _backfill_numbers,
+    ]),
+    (4, [
+        # Searches moved to the Current* tables in 2, so the history indexes from 1 only cost
+        # writes. History is read by docID, which the primary keys already cover
+        "DROP INDEX IF EXISTS Metadata_type_key_val",
+        "DROP INDEX IF EXISTS DocSets_docSetId",
+        "DROP INDEX IF EXISTS DocSets_docID",
+        "DROP INDEX IF EXISTS Metasheets_status",
+        "DROP INDEX IF EXISTS Metasheets_targetClass",
+        "DROP INDEX IF EXISTS Metasheets_siteClass",
+    ]),
+]
+
+
+def _migrate(con):
+    """ Apply any migrations this database hasn't seen yet """
+    cur = con.cursor()
+    if cur.execute("PRAGMA user_version").fetchone()[0] >= _MIGRATIONS[-1][0]:
+        return
+
+    # Take the write lock before checking again, in case another worker is migrating too
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        for migration_version, statements in _MIGRATIONS:
+            if migration_version <= version:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(cur)
+                else:
+                    cur.execute(statement)
+            cur.execute(f"PRAGMA user_version={migration_version}")
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+
+def _open_connection(fn):
+    """ Open a new connection and apply the tuning pragmas from the [SQL] config section """
+    config_field = "SQL"
+    con = sqlite3.connect(fn, timeout=config.getfloat(config_field, "busy_timeout", fallback=30),
+                          check_same_thread=False) # So close_connections() can run from any thread
+
+    # WAL lets readers keep going while a single writer commits, which is what we want with
+    # multiple uvicorn workers pointed at the same file
+    journal_mode = config.get(config_field, "journal_mode", fallback="WAL").upper()
+    if journal_mode not in _JOURNAL_MODES:
+        raise ValueError(f"Invalid SQL.journal_mode {journal_mode}")
+    synchronous = config.get(config_field, "synchronous", fallback="NORMAL").upper()
+    if synchronous not in _SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid SQL.synchronous {synchronous}")
+    cache_size = config.getint(config_field, "cache_size", fallback=-20000) # Negative is KiB
+    mmap_size = config.getint(config_field, "mmap_size", fallback=0)
+
+    con.execute(f"PRAGMA journal_mode={journal_mode}")
+    con.execute(f"PRAGMA synchronous={synchronous}")
+    con.execute(f"PRAGMA cache_size={cache_size}")
+    con.execute(f"PRAGMA mmap_size={mmap_size}")
+    return con
+
+
+_executor = None # Threads for AsyncSQLRepository, created on first use
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor # pylint: disable=global-statement
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.getint("SQL", "async_workers", fallback=4),
+                                           thread_name_prefix="sqlite")
+        return _executor
+
+
+def close_connections():
+    """ Close every connection this process has opened """
+    with _connections_lock:
+        for con in _connections:
+            con.close()
+        _connections.clear()
+
+atexit.register(close_connections)
+
+
+def _prune_connections():
+    """ Close the connections of threads that have exited. Must be called with _connections_lock held """
+    for con, thread in list(_connections.items()):
+        if not thread.is_alive():
+            con.close()
+            del _connections[con]
+
 class SQLRepository(RepoBase):
     """
     Implementation of a SQL based Metarepo. Because we can't store an arbitrary dict
     and still have performant searches, we arrange things a bit differently. All metadata
     goes into a Metadata table regardless of type, and can get organized into dicts
     when extracting. DocSets go into a dict as well. Everything has a primary key
-    timestamp, so the archives just a matter of just organizing by timestamp and metadata type
+    timestamp, so the archives just a matter of just organizing by timestamp and metadata type.
+    Those three tables are the history. The latest version of each document is also kept in
+    CurrentMetasheets, CurrentMetadata and CurrentDocSets, which are what searches run against
     """
 
+    @classmethod
+    def close(cls):
+        close_connections()
+
     def _connect_sql(self):
-        """ Perform the connection to sqlite, and initialize tables if necessary """
+        """ Get this thread's connection to sqlite, opening it and initializing tables if necessary """
+        con = getattr(_local, "connection", None)
+        if con is not None and con in _connections: # Not closed by close_connections()
+            return con
+
         fn = config.get("SQL", "db_filename")
-        con = sqlite3.connect(fn)
-        cur = con.cursor()
-        cur.execute("""CREATE TABLE IF NOT EXISTS
-                    Metasheets (docID CHAR, timestamp INT, displayName CHAR, targetClass CHAR, siteClass CHAR, status INT,
-                                PRIMARY KEY (docID, timestamp))
-                    """)
-        cur.execute("""CREATE TABLE IF NOT EXISTS
-                    Metadata (docID CHAR, timestamp INT, key CHAR, val CHAR, type CHAR,
-                              PRIMARY KEY (docID, timestamp, key, type),
-                              FOREIGN KEY(docID) REFERENCES Metasheets(docID))
-                    """)
-        cur.execute("""CREATE TABLE IF NOT EXISTS
-                    DocSets (docID CHAR, timestamp INT, docSetId CHAR,
-                             FOREIGN KEY(docID) REFERENCES Metasheets(docID))
-                    """)
-        
-        con.commit() # Save new tables, if they were created
+        con = _open_connection(fn)
+        with _connections_lock:
+            _prune_connections()
+            if fn not in _schema_ready:
+                _create_schema(con)
+                _schema_ready.add(fn)
+            _connections[con] = threading.current_thread()
+        _local.connection = con
         return con
     
-    def _get_metasheet(self, docId, con):
-        """ Given a docId, get the entire document including metasheet and archives """
+    def get(self, doc_id: str, fields: list=None):
+        """ Primary key lookups on the current tables. History is only read if archives are wanted """
+        metasheets = self._get_metasheets([doc_id], self._connect_sql(), fields)
+        return metasheets[0] if metasheets else None
+
+    def get_many(self, doc_ids: list, fields: list=None):
+        """ The same chunked IN (...) queries as find, so a batch costs a handful of queries """
+        return self._get_metasheets(doc_ids, self._connect_sql(), fields)
+
+    def _get_metasheets(self, docIds, con, fields=None):
+        """ Given a list of docIds, get the entire documents including metasheets and archives.
+        Rather than querying per document, pull each table in chunks with IN (...) and group the
+        rows by docId in one pass, so the number of queries doesn't grow with the result size.
+        Current values come from the Current* tables, history is only read to build the archives.
+        If fields are given, tables that nothing asked for aren't read at all """
+        docIds = list(dict.fromkeys(docIds)) # Drop duplicates, but keep the caller's order
+        read_metadata = any(wants_field(fields, mType) for mType in _METADATA_TYPES)
+        read_docsets = wants_field(fields, "docSetId")
+        read_history = wants_field(fields, "frameworkArchive")
+        read_metadata_history = any(wants_field(fields, archive) for archive in ARCHIVE_FIELDS[1:])
+        current_rows = {}
+        current_metadata = {docId: [] for docId in docIds}
+        current_docsets = {docId: [] for docId in docIds}
+        metasheet_rows = {docId: [] for docId in docIds}
+        metadata_rows = {docId: [] for docId in docIds}
+
         cur = con.cursor()
-        res = cur.execute(f"SELECT * FROM Metasheets WHERE docID = '{docId}' ORDER BY timestamp DESC")
-        metasheets_sql = res.fetchall()
-        
-        res = cur.execute(f"SELECT * FROM Metadata WHERE docID = '{docId}' ORDER BY timestamp DESC")
-        metadata = res.fetchall()
+        for idx in range(0, len(docIds), _HYDRATE_CHUNK_SIZE):
+            chunk = docIds[idx:idx+_HYDRATE_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            res = cur.execute(f"SELECT * FROM CurrentMetasheets WHERE docID IN ({placeholders})", chunk)
+            for row in res:
+                current_rows[row[0]] = row
+            if read_metadata:
+                res = cur.execute(f"SELECT * FROM CurrentMetadata WHERE docID IN ({placeholders})", chunk)
+                for row in res:
+                    current_metadata[row[0]].append(row)
+            if read_docsets:
+                res = cur.execute(f"SELECT * FROM CurrentDocSets WHERE docID IN ({placeholders}) ORDER BY docID, rowid", chunk)
+                for row in res:
+                    current_docsets[row[0]].append(row)
+            if read_history:
+                res = cur.execute(f"SELECT * FROM Metasheets WHERE docID IN ({placeholders}) ORDER BY docID, timestamp DESC", chunk)
+                for row in res:
+                    metasheet_rows[row[0]].append(row)
+            if read_metadata_history:
+                res = cur.execute(f"SELECT * FROM Metadata WHERE docID IN ({placeholders}) ORDER BY docID, timestamp DESC", chunk)
+                for row in res:
+                    metadata_rows[row[0]].append(row)
 
-        res = cur.execute(f"SELECT * FROM DocSets WHERE docID = '{docId}'")
-        docsets = res.fetchall()
-        
+        metasheets = []
+        for docId in docIds:
+            if docId not in current_rows: # Nothing stored under this docId
+                continue
+            metasheet = self._build_current(current_rows[docId], current_metadata[docId],
+                                            current_docsets[docId])
+            if read_history or read_metadata_history:
+                self._build_archives(metasheet, metasheet_rows[docId], metadata_rows[docId])
+            metasheets.append(project(metasheet, fields))
+        return metasheets
+
+    def _build_current(self, current_row, current_metadata, current_docsets):
+        """ Turn the current rows for a single docId into a metasheet, without archives """
+        metasheet = {}
+        metasheet["docId"] = current_row[0]
+        metasheet["timestamp"] = current_row[1]
+        metasheet["displayName"] = current_row[2]
+        metasheet["targetClass"] = current_row[3]
+        metasheet["siteClass"] = current_row[4]
+        metasheet["status"] = current_row[5]
+        metasheet["userMetadata"] = {}
+        metasheet["siteMetadata"] = {}
+        metasheet["targetMetadata"] = {}
+        for datum in current_metadata:
+            metasheet[datum[3]][datum[1]] = _decode_value(datum[2], datum[5])
+        metasheet["docSetId"] = [docset[1] for docset in current_docsets]
+        return metasheet
+
+    def _build_archives(self, metasheet, metasheets_sql, metadata):
+        """ Fill in a metasheet's archives from its history rows, newest first """
         # Turn the metasheet data into a list of dicts
         metasheets = []
         for meta_sql in metasheets_sql:
@@ -64,10 +406,6 @@ class SQLRepository(RepoBase):
             meta_dict["status"] = meta_sql[5]
             metasheets.append(meta_dict)
         
-        metasheet = metasheets[0] # Since we ordered by descending timestamp, this will be the most recent
-        metasheet["userMetadata"] = {}
-        metasheet["siteMetadata"] = {}
-        metasheet["targetMetadata"] = {}
         metasheet["frameworkArchive"] = []
         metasheet["metadataArchive"] = []
         metasheet["targetMetadataArchive"] = []
@@ -87,7 +425,7 @@ class SQLRepository(RepoBase):
         for datum in metadata:
             timestamp = datum[1]
             key = datum[2]
-            val = datum[3]
+            val = _decode_value(datum[3], datum[6])
             mType = datum[4]
             if timestamp not in metadata_dict[mType]:
                 metadata_dict[mType][timestamp] = {}
@@ -116,97 +454,383 @@ class SQLRepository(RepoBase):
                                      "comment" : '', # Should probably use a new table or something for comment archives
                                      "previous" : metadata_dict["targetMetadata"][timestamps[idx+1]]
                                      })
-            
-        # Lastly, we need docsets
-        metasheet["docSetId"] = []
-        for docset in docsets:
-            metasheet["docSetId"].append(docset[2])
-        
+
         return metasheet
     
-    def find(self, filters: dict=None, groups: list=None, page: int=0):
+    def _value_clauses(self, conditions, column, metadata):
+        """ SQL for the conditions on one filter, from filter_conditions. column is the framework
+        column, or for metadata the CurrentMetadata row, whose text, number and type are in
+        val, num and vtype. Returns (clauses, params) """
+        clauses = []
+        params = []
+        text_column = "val" if metadata else column
+        for op, operand in conditions:
+            if op in ("eq", "in"):
+                operands = [operand] if op == "eq" else operand
+                if not operands:
+                    clauses.append("0")
+                elif metadata:
+                    clause, clause_params = _typed_equals(operands)
+                    clauses.append(clause)
+                    params.extend(clause_params)
+                else:
+                    clauses.append(f"{column} IN ({','.join('?' * len(operands))})")
+                    params.extend(operands)
+            elif op == "prefix":
+                # A range on the text rather than LIKE, so the index can be used
+                clauses.append(f"{text_column} >= ?")
+                params.append(operand)
+                upper = prefix_upper_bound(operand)
+                if upper is not None:
+                    clauses.append(f"{text_column} < ?")
+                    params.append(upper)
+                if metadata: # Only strings have a prefix
+                    clauses.append(_STRING_ROWS)
+            else:
+                comparison = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<="}[op]
+                if not metadata:
+                    clauses.append(f"{column} {comparison} ?")
+                elif isinstance(operand, str): # Strings compare with strings
+                    clauses.append(f"val {comparison} ? AND {_STRING_ROWS}")
+                else:
+                    clauses.append(f"num {comparison} ?")
+                params.append(operand)
+        return clauses, params
+
+    def _where(self, filters, groups):
+        """ Turn a set of filters into conditions on CurrentMetasheets m, returning (conditions, params).
+        Every filter must match (AND), and if groups are given the siteMetadata.tenant must be one of them.
+        Each filter is a plain value or operators (see filter_conditions), all run against an index.
+        A docSetId filter matches documents with any docSet that satisfies it """
+        conditions = []
+        params = []
+        for tag in filters:
+            filter_parts = filter_conditions(filters[tag])
+            if tag == "docSetId":
+                clauses, clause_params = self._value_clauses(filter_parts, "docSetId", metadata=False)
+                conditions.append("m.docID IN (SELECT docID FROM CurrentDocSets WHERE "
+                                  + " AND ".join(clauses) + ")")
+                params.extend(clause_params)
+            elif '.' in tag: # This is metadata
+                mType, key = tag.split('.', 1)
+                if mType not in _METADATA_TYPES:
+                    raise HTTPException(status_code=400, detail=f"Unknown metadata type {mType}")
+                clauses, clause_params = self._value_clauses(filter_parts, None, metadata=True)
+                conditions.append("m.docID IN (SELECT docID FROM CurrentMetadata WHERE type=? AND key=? AND "
+                                  + " AND ".join(clauses) + ")")
+                params.extend([mType, key] + clause_params)
+            else:
+                if tag not in _FRAMEWORK_COLUMNS:
+                    raise HTTPException(status_code=400, detail=f"Cannot filter on field {tag}")
+                clauses, clause_params = self._value_clauses(filter_parts, f"m.{_FRAMEWORK_COLUMNS[tag]}",
+                                                             metadata=False)
+                conditions.extend(clauses)
+                params.extend(clause_params)
+
+        if groups:
+            placeholders = ",".join("?" * len(groups))
+            conditions.append("m.docID IN (SELECT docID FROM CurrentMetadata WHERE type='siteMetadata' "
+                              f"AND key='tenant' AND val IN ({placeholders}))")
+            params.extend(groups)
+        return conditions, params
+
+    def validate(self, filters: dict=None, groups: list=None) -> None:
+        """ _where raises on anything it can't compile """
+        self._where(filters or {}, groups or [])
+
+    def _compile_find(self, filters, groups, page, after=None):
+        """ A single parameterized query returning the docIDs matching filters and groups (see _where).
+        If after is given, page by docID keyset instead of offset """
+        conditions, params = self._where(filters, groups)
+        if after is not None:
+            conditions.append("m.docID > ?")
+            params.append(after)
+
+        query = "SELECT m.docID FROM CurrentMetasheets m"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY m.docID LIMIT ? OFFSET ?"
+        params.extend([_PAGE_SIZE, 0 if after is not None else page*_PAGE_SIZE])
+        return query, params
+
+    def find(self, filters: dict=None, groups: list=None, page: int=0, fields: list=None):
         if filters is None: filters = {}
+        if groups is None: groups = []
 
         con = self._connect_sql()
-        cur = con.cursor()
+        query, params = self._compile_find(filters, groups, page)
+        docIds = [row[0] for row in con.execute(query, params)]
+        return self._get_metasheets(docIds, con, fields)
 
-        docIds = None
-        for tag in filters:
-            if '.' in tag: # This is metadata
-                val = filters[tag]
-                mType, tag = tag.split('.')
-                res = cur.execute(f"""
-                              SELECT docID FROM Metadata WHERE key='{tag}' and val='{val}' and type='{mType}'
-                              """)
-            else:
-                val = filters[tag]
-                res = cur.execute(f"""
-                                  SELECT docID from Metasheets WHERE {tag}='{val}'""")
-            res = res.fetchall()
-            filter_docIds = set()
-            for doc in res: # Store docIds as a set, so they don't get added in multiple times
-                filter_docIds.add(doc[0])
-                
-            # We ONLY want docIds that fit every single filter, so take a union as we go
-            if docIds is None:
-                docIds = filter_docIds
-            else:
-                docIds = docIds.union(filter_docIds)
-                
-        metasheets = []
-        for docId in docIds:
-            metasheets.append(self._get_metasheet(docId, con))
-        return metasheets
+    def find_page(self, filters: dict=None, groups: list=None, cursor: str=None, fields: list=None):
+        if filters is None: filters = {}
+        if groups is None: groups = []
+        after = decode_cursor(cursor).get("after", "") if cursor else ""
+
+        con = self._connect_sql()
+        query, params = self._compile_find(filters, groups, 0, after)
+        docIds = [row[0] for row in con.execute(query, params)]
+        next_cursor = encode_cursor({"after": docIds[-1]}) if len(docIds) == _PAGE_SIZE else None
+        return self._get_metasheets(docIds, con, fields), next_cursor
     
-    def notate(self, doc: dict) -> None:
-        try:
-            con = self._connect_sql()
-            cur = con.cursor()
-            
-            # Add in the main document, with no metadata or docsets
+    def count_docsets(self, doc_set_ids: list, filters: dict=None, groups: list=None) -> dict:
+        """ One grouped count over the docSet index, joined to the filters. No documents are read """
+        if filters is None: filters = {}
+        if groups is None: groups = []
+        doc_set_ids = list(dict.fromkeys(doc_set_ids))
+        counts = dict.fromkeys(doc_set_ids, 0)
+        con = self._connect_sql()
+        for idx in range(0, len(doc_set_ids), _HYDRATE_CHUNK_SIZE):
+            chunk = doc_set_ids[idx:idx+_HYDRATE_CHUNK_SIZE]
+            conditions, params = self._where(filters, groups)
+            conditions.insert(0, f"ds.docSetId IN ({','.join('?' * len(chunk))})")
+            query = ("SELECT ds.docSetId, COUNT(DISTINCT m.docID) FROM CurrentDocSets ds "
+                     "JOIN CurrentMetasheets m ON m.docID = ds.docID WHERE " + " AND ".join(conditions)
+                     + " GROUP BY ds.docSetId")
+            for doc_set_id, count in con.execute(query, chunk + params):
+                counts[doc_set_id] = count
+        return counts
+
+    def _insert_docs(self, cur, docs):
+        """ Write whole documents to history and replace their current rows. Each table gets a
+        single executemany no matter how many docs there are. Doesn't commit """
+        timestamp = time.time()
+        rows = []
+        metadata = []
+        docsets = []
+        for doc in docs:
+            # The main document, with no metadata or docsets
             docID = doc["docId"]
-            timestamp = time.time()
-            displayName = doc["displayName"]
-            targetClass = doc["targetClass"]
-            siteClass = doc["siteClass"]
-            status = doc["status"]
-            cur.execute(f"""
-                        INSERT INTO Metasheets VALUES
-                        ('{docID}', {timestamp}, '{displayName}', '{targetClass}', '{siteClass}', {status})
-                        """)
-            
-            # Add in metadata, compressing to a single insert. We should always have at least some, thanks to site/target
-            metadataQuery = "INSERT INTO Metadata VALUES"
-            metadataTypes = ['userMetadata', 'siteMetadata', 'targetMetadata']
-            for mType in metadataTypes:
+            rows.append((docID, timestamp, doc["displayName"], doc["targetClass"], doc["siteClass"], doc["status"]))
+
+            # Metadata. We should always have at least some, thanks to site/target
+            for mType in _METADATA_TYPES:
                 for key in doc[mType]:
-                    val = str(doc[mType][key]) # It should be a string, but double check
-                    metadataQuery += f" ('{docID}', {timestamp}, '{key}', '{val}', '{mType}'),"
-            metadataQuery = metadataQuery[:-1]
-            cur.execute(metadataQuery)
-
-            # Add in docsets, compressing to a single insert
-            if doc["docSetId"]:
-               docSetQuery = "INSERT INTO DocSets VALUES"
-               for docSet in doc["docSetId"]:
-                   docSetQuery += f" ('{docID}', {timestamp}, '{docSet}'),"
-               docSetQuery = docSetQuery[:-1] # Cut off trailing comma
-               cur.execute(docSetQuery)
+                    val, num, vtype = _encode_value(doc[mType][key])
+                    metadata.append((docID, key, val, mType, num, vtype))
+
+            for docSet in doc["docSetId"]:
+                docsets.append((docID, docSet))
+
+        docIDs = [(row[0],) for row in rows]
+        cur.executemany("INSERT INTO Metasheets VALUES (?, ?, ?, ?, ?, ?)", rows)
+        cur.executemany("INSERT OR REPLACE INTO CurrentMetasheets VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+        cur.executemany("INSERT INTO Metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(docID, timestamp, key, val, mType, num, vtype)
+                         for docID, key, val, mType, num, vtype in metadata])
+        cur.executemany("DELETE FROM CurrentMetadata WHERE docID = ?", docIDs)
+        cur.executemany("INSERT INTO CurrentMetadata VALUES (?, ?, ?, ?, ?, ?)", metadata)
+
+        cur.executemany("INSERT INTO DocSets VALUES (?, ?, ?)",
+                        [(docID, timestamp, docSet) for docID, docSet in docsets])
+        cur.executemany("DELETE FROM CurrentDocSets WHERE docID = ?", docIDs)
+        cur.executemany("INSERT INTO CurrentDocSets VALUES (?, ?)", docsets)
+
+    def _check_new(self, con, docs):
+        """ Raise if any of the docs is already stored, as the other repos do, rather than
+        quietly replacing it and adding to its history """
+        doc_ids = [doc["docId"] for doc in docs]
+        for idx in range(0, len(doc_ids), _HYDRATE_CHUNK_SIZE):
+            chunk = doc_ids[idx:idx+_HYDRATE_CHUNK_SIZE]
+            row = con.execute(f"SELECT docID FROM CurrentMetasheets WHERE docID IN ({','.join('?' * len(chunk))}) "
+                              "LIMIT 1", chunk).fetchone()
+            if row is not None:
+                raise HTTPException(status_code=500,
+                                    detail=f"Document {row[0]} already exists in repo!")
+
+    def notate(self, doc: dict) -> None:
+        con = self._connect_sql()
+        self._check_new(con, [doc])
+        try:
+            self._insert_docs(con.cursor(), [doc])
+            con.commit()
+        except Exception as ex:
+            con.rollback() # The connection is reused, so don't leave a half written doc behind
+            print(f"Notate failed: {ex}")
+            raise HTTPException(status_code=500,
+                                detail=f"Notate failed: {ex}")
+
+    def notate_many(self, docs: list) -> None:
+        """ All the docs go in one transaction, so either every one is added or none are """
+        con = self._connect_sql()
+        self._check_new(con, docs)
+        try:
+            self._insert_docs(con.cursor(), docs)
             con.commit()
-            
         except Exception as ex:
+            con.rollback()
             print(f"Notate failed: {ex}")
             raise HTTPException(status_code=500,
                                 detail=f"Notate failed: {ex}")
 
-    def update(self, doc_id: str, update_fields: dict) -> None:
+    def _history_states(self, archive, current, field, timestamp):
+        """ Walk an archive backwards from the current value, giving each state the metasheet
+        has been in as (timestamp, value), oldest first. The archive entry written when a value
+        changed has that change's timestamp and the value before it, so the oldest state gets a
+        time just before the first change, unless the metasheet's own timestamp is earlier.
+        field is the framework field to follow, or None for a metadata archive """
+        entries = sorted((entry for entry in archive if isinstance(entry, dict) and "timestamp" in entry),
+                         key=lambda entry: entry["timestamp"])
+        if not entries:
+            return [(timestamp, current)]
+
+        values = [current]
+        for entry in reversed(entries):
+            value = values[-1]
+            previous = entry.get("previous")
+            if field is None: # Metadata archives hold the whole previous metadata
+                value = previous if isinstance(previous, dict) else value
+            elif isinstance(previous, dict): # Archives written by MetaRepo hold the changed fields
+                value = previous.get(field, value)
+            elif previous is not None: # Archives read back from SQL hold the old value itself
+                value = previous
+            values.append(value)
+        values.reverse()
+
+        first = entries[0]["timestamp"]
+        start = timestamp if timestamp < first else first - 0.001
+        return [(start, values[0])] + [(entry["timestamp"], value) for entry, value in zip(entries, values[1:])]
+
+    def restore_many(self, docs: list) -> None:
+        """ Like notate_many, but rebuilds each metasheet's history rows from its archives, so the
+        archives read back the same. SQL has nowhere to keep an archive entry's userId or
+        comment, so those are not kept. All the docs go in one transaction """
+        con = self._connect_sql()
+        rows = {}
+        metadata = {}
+        current_rows = []
+        current_metadata = []
+        docsets = []
+        for doc in docs:
+            docID = doc["docId"]
+            timestamp = doc.get("timestamp") or time.time()
+            name_states = self._history_states(doc.get("frameworkArchive", []), doc["displayName"],
+                                               "displayName", timestamp)
+            for state_time, name in name_states:
+                rows[(docID, state_time)] = (docID, state_time, name, doc["targetClass"],
+                                             doc["siteClass"], doc["status"])
+            current_time = max(timestamp, name_states[-1][0])
+            current_rows.append((docID, current_time, doc["displayName"], doc["targetClass"],
+                                 doc["siteClass"], doc["status"]))
+
+            for mType, archive in zip(_METADATA_TYPES, ["metadataArchive", "siteMetadataArchive",
+                                                        "targetMetadataArchive"]):
+                for state_time, state in self._history_states(doc.get(archive, []), doc[mType],
+                                                               None, timestamp):
+                    for key, val in state.items():
+                        metadata[(docID, state_time, key, mType)] = (docID, state_time, key, mType,
+                                                                     *_encode_value(val))
+                current_metadata.extend((docID, key, mType, *_encode_value(val)) for key, val in doc[mType].items())
+
+            docsets.extend((docID, current_time, docSet) for docSet in doc["docSetId"])
+
+        docIDs = [(row[0],) for row in current_rows]
         try:
-            con = self._connect_sql()
-            metasheet = self._get_metasheet(doc_id, con)
-            for key in update_fields:
-                metasheet[key] = update_fields[key]
-            self.notate(metasheet)
+            cur = con.cursor()
+            cur.executemany("INSERT OR REPLACE INTO Metasheets VALUES (?, ?, ?, ?, ?, ?)", list(rows.values()))
+            cur.executemany("INSERT OR REPLACE INTO CurrentMetasheets VALUES (?, ?, ?, ?, ?, ?)", current_rows)
+            cur.executemany("""INSERT OR REPLACE INTO Metadata (docID, timestamp, key, type, val, num, vtype)
+                               VALUES (?, ?, ?, ?, ?, ?, ?)""", list(metadata.values()))
+            cur.executemany("DELETE FROM CurrentMetadata WHERE docID = ?", docIDs)
+            cur.executemany("""INSERT INTO CurrentMetadata (docID, key, type, val, num, vtype)
+                               VALUES (?, ?, ?, ?, ?, ?)""", current_metadata)
+            cur.executemany("INSERT INTO DocSets VALUES (?, ?, ?)", docsets)
+            cur.executemany("DELETE FROM CurrentDocSets WHERE docID = ?", docIDs)
+            cur.executemany("INSERT INTO CurrentDocSets VALUES (?, ?)", [(docID, docSet) for docID, _, docSet in docsets])
+            con.commit()
         except Exception as ex:
+            con.rollback()
+            print(f"Restore failed: {ex}")
+            raise HTTPException(status_code=500,
+                                detail=f"Restore failed: {ex}")
+
+    def update(self, doc_id: str, update_fields: dict, if_match: str=None) -> None:
+        """ Only write what actually changed: a framework history row if a framework field changed,
+        a history snapshot of each metadata type that changed, and the affected current rows """
+        con = self._connect_sql()
+        try:
+            cur = con.cursor()
+            if if_match is not None:
+                # Take the write lock first, so nobody can change the doc between the check and our write
+                cur.execute("BEGIN IMMEDIATE")
+                for metasheet in self._get_metasheets([doc_id], con):
+                    check_etag(metasheet, if_match)
+            current = cur.execute("SELECT * FROM CurrentMetasheets WHERE docID = ?", (doc_id,)).fetchone()
+            if current is None:
+                raise HTTPException(status_code=500,
+                                    detail=f"Document {doc_id} does not exist in repo!")
+            timestamp = time.time()
+
+            # Framework fields. The current row's timestamp always moves forward, but history
+            # only gets a new row if something in it changed
+            row = list(current)
+            row[1] = timestamp
+            for idx, field in enumerate(_METASHEET_COLUMNS):
+                if idx > 1 and field in update_fields:
+                    row[idx] = update_fields[field]
+            if row[2:] != list(current[2:]):
+                cur.execute("INSERT INTO Metasheets VALUES (?, ?, ?, ?, ?, ?)", row)
+            cur.execute("""UPDATE CurrentMetasheets SET timestamp = ?, displayName = ?, targetClass = ?,
+                           siteClass = ?, status = ? WHERE docID = ?""", row[1:] + [doc_id])
+
+            # Each metadata type is replaced as a whole, so compare against what's stored now and
+            # only touch the keys that differ
+            for mType in _METADATA_TYPES:
+                if mType not in update_fields:
+                    continue
+                new_metadata = {key: _encode_value(val) for key, val in update_fields[mType].items()}
+                # A value is unchanged if its text and type are. Untyped rows were strings
+                old_metadata = {key: (val, num, vtype or "str") for key, val, num, vtype in cur.execute(
+                    "SELECT key, val, num, vtype FROM CurrentMetadata WHERE docID = ? AND type = ?", (doc_id, mType))}
+                changed = {key: encoded for key, encoded in new_metadata.items()
+                           if key not in old_metadata or
+                           (old_metadata[key][0], old_metadata[key][2]) != (encoded[0], encoded[2])}
+                if not changed and len(new_metadata) == len(old_metadata):
+                    continue
+                cur.executemany("INSERT INTO Metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(doc_id, timestamp, key, val, mType, num, vtype)
+                                 for key, (val, num, vtype) in new_metadata.items()])
+                cur.executemany("DELETE FROM CurrentMetadata WHERE docID = ? AND type = ? AND key = ?",
+                                [(doc_id, mType, key) for key in old_metadata if key not in new_metadata])
+                cur.executemany("INSERT OR REPLACE INTO CurrentMetadata VALUES (?, ?, ?, ?, ?, ?)",
+                                [(doc_id, key, val, mType, num, vtype) for key, (val, num, vtype) in changed.items()])
+
+            if "docSetId" in update_fields:
+                old_docsets = [row[0] for row in cur.execute(
+                    "SELECT docSetId FROM CurrentDocSets WHERE docID = ? ORDER BY rowid", (doc_id,))]
+                if update_fields["docSetId"] != old_docsets:
+                    cur.executemany("INSERT INTO DocSets VALUES (?, ?, ?)",
+                                    [(doc_id, timestamp, docSet) for docSet in update_fields["docSetId"]])
+                    cur.execute("DELETE FROM CurrentDocSets WHERE docID = ?", (doc_id,))
+                    cur.executemany("INSERT INTO CurrentDocSets VALUES (?, ?)",
+                                    [(doc_id, docSet) for docSet in update_fields["docSetId"]])
+            con.commit()
+        except HTTPException:
+            con.rollback()
+            raise
+        except Exception as ex:
+            con.rollback()
             print(f"Update failed: {ex}")
             raise HTTPException(status_code=500,
                                 detail=f"Update failed: {ex}")
+
+
+class AsyncSQLRepository(AsyncRepoAdapter):
+    """
+    sqlite has no async driver, so the async repo runs SQLRepository on a small pool of its own
+    threads rather than the shared threadpool. Each of those threads keeps its connection open,
+    and since sqlite only allows one writer at a time, a few threads is all it can use anyway
+    """
+    repo_class = SQLRepository
+
+    async def _run_in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), functools.partial(func, *args))
+
+    @classmethod
+    async def aclose(cls):
+        global _executor # pylint: disable=global-statement
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+                _executor = None
@@ -0,0 +1,208 @@
+""" An optional cache of /find results, so that dashboards repeating the same search every few
+seconds don't each cost a full repo query.
+
+Entries are keyed by the normalized filters, the caller's groups and the projection. Rather than
+working out which cached searches a write touches, every write bumps a version counter and each
+entry remembers the version it was read at, so any write makes every older entry a miss. The
+counter lives in a backend: "local" keeps it in process, which is enough for a single worker, and
+"sqlite" keeps it in a small shared file so that every uvicorn worker sees every other worker's
+writes. A custom backend can be given as a dotted path to a CacheBackend subclass.
+
+get, version and invalidate are coroutines. Backends that block, like sqlite waiting on a busy
+file, are called from the threadpool so they can't stall the event loop """
+
+import configparser
+import importlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+
+config = configparser.ConfigParser()
+config.read('metarepo.conf')
+
+_ENABLED = config.getboolean('CACHE', 'enabled', fallback=False)
+_CACHE_SIZE = config.getint('CACHE', 'size', fallback=1024)
+_CACHE_TTL = config.getfloat('CACHE', 'ttl', fallback=5)
+_MAX_BYTES = config.getint('CACHE', 'max_bytes', fallback=64*1024*1024)
+_BACKEND = config.get('CACHE', 'backend', fallback='local')
+
+_cache = OrderedDict() # key -> (version, evict_at, results, size), in LRU order
+_cache_lock = threading.Lock()
+_cache_bytes = 0
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class CacheBackend:
+    """ Holds the write counter. Subclasses must make bump() visible to every worker sharing the repo.
+    Set blocking to False only if version() and bump() never wait on I/O or other processes, so
+    they can be called on the event loop """
+    blocking = True
+
+    def version(self) -> int:
+        """ The current write counter """
+        raise NotImplementedError
+
+    def bump(self) -> None:
+        """ Record that the repo was written to """
+        raise NotImplementedError
+
+
+class LocalBackend(CacheBackend):
+    """ An in-process counter. Only coherent with a single worker """
+    blocking = False
+
+    def __init__(self):
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def version(self) -> int:
+        return self._version
+
+    def bump(self) -> None:
+        with self._lock:
+            self._version += 1
+
+
+class SQLiteBackend(CacheBackend):
+    """ A counter in a shared sqlite file, so every worker on the host stays coherent. Reading it
+    is a single row lookup. Connections are per thread, like the SQL repo's """
+
+    def __init__(self):
+        self._filename = config.get('CACHE', 'version_db', fallback='metarepo_cache.db')
+        self._local = threading.local()
+        con = self._connect()
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS CacheVersion(id INTEGER PRIMARY KEY, version INTEGER)")
+            con.execute("INSERT OR IGNORE INTO CacheVersion VALUES(0, 0)")
+
+    def _connect(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self._filename, timeout=30, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            self._local.con = con
+        return con
+
+    def version(self) -> int:
+        return self._connect().execute("SELECT version FROM CacheVersion WHERE id=0").fetchone()[0]
+
+    def bump(self) -> None:
+        self._connect().execute("UPDATE CacheVersion SET version=version+1 WHERE id=0")
+
+
+_BACKENDS = {"local": LocalBackend, "sqlite": SQLiteBackend}
+
+
+def _get_backend():
+    """ Create the configured backend on first use """
+    global _backend # pylint: disable=global-statement
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_class = _BACKENDS.get(_BACKEND)
+                if backend_class is None: # A dotted path to someone's own backend
+                    module_name, class_name = _BACKEND.rsplit('.', 1)
+                    backend_class = getattr(importlib.import_module(module_name), class_name)
+                _backend = backend_class()
+    return _backend
+
+
+async def _call_backend(method_name):
+    """ Call a backend method, in the threadpool if the backend might block """
+    backend = _get_backend()
+    method = getattr(backend, method_name)
+    if backend.blocking:
+        return await run_in_threadpool(method)
+    return method()
+
+
+def make_key(filters, groups, fields):
+    """ Normalize a search so that equivalent ones share an entry. None means no caching """
+    if not _ENABLED:
+        return None
+    return json.dumps([filters, sorted(groups), sorted(fields) if fields is not None else None],
+                      sort_keys=True, default=str)
+
+
+def _drop(key):
+    """ Remove an entry. Must be called with _cache_lock held """
+    global _cache_bytes # pylint: disable=global-statement
+    _cache_bytes -= _cache.pop(key)[3]
+
+
+async def get(key):
+    """ Look up a search. Returns None on a miss. The results are shared, so callers mustn't modify them """
+    if key is None:
+        return None
+    version = await _call_backend("version")
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        entry_version, evict_at, results, _ = entry
+        if entry_version != version or evict_at <= time.time():
+            _drop(key)
+            _stats["misses"] += 1
+            return None
+        _cache.move_to_end(key)
+        _stats["hits"] += 1
+        return results
+
+
+async def version():
+    """ The version to store a search under. Read it before querying the repo, so that a write
+    landing mid query leaves the entry already out of date rather than hiding the write """
+    return await _call_backend("version") if _ENABLED else None
+
+
+def put(key, read_version, results):
+    """ Store a search's results, evicting the least recently used entries to stay under both
+    the entry count and the memory ceiling """
+    global _cache_bytes # pylint: disable=global-statement
+    if key is None or _CACHE_SIZE <= 0:
+        return
+    # The serialized size is a fair stand in for what the results cost in memory
+    size = len(key) + len(json.dumps(results, default=str))
+    if size > _MAX_BYTES:
+        return
+    with _cache_lock:
+        if key in _cache:
+            _drop(key)
+        _cache[key] = (read_version, time.time() + _CACHE_TTL, results, size)
+        _cache_bytes += size
+        while len(_cache) > _CACHE_SIZE or _cache_bytes > _MAX_BYTES:
+            _drop(next(iter(_cache)))
+
+
+async def invalidate():
+    """ Called after every write to the repo, making every cached search out of date """
+    if not _ENABLED:
+        return
+    await _call_backend("bump")
+    with _cache_lock:
+        _stats["invalidations"] += 1
+
+
+def cache_stats():
+    """ Hit/miss counters for the find cache """
+    with _cache_lock:
+        stats = dict(_stats)
+        stats["size"] = len(_cache)
+        stats["bytes"] = _cache_bytes
+    return stats
+
+
+def clear_cache():
+    """ Drop every cached search in this worker """
+    global _cache_bytes # pylint: disable=global-statement
+    with _cache_lock:
+        _cache.clear()
+        _cache_bytes = 0
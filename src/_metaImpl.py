@@ -7,13 +7,19 @@ import uuid
 from enum import Enum
 from fastapi import HTTPException
 
-from ._resolver import get_meta_site, get_meta_target, get_repo
+from . import _findcache, _metrics, _profiling
+from ._resolver import async_repo, meta_site, meta_target, reload_plugins
 from .auth import get_groups
+from .Repository.RepositoryBase import check_etag, filter_conditions, project
 
 
 config = configparser.ConfigParser()
 config.read('metarepo.conf')
 
+# Upper bound on the number of docIds a single /docs/mget may ask for
+_MGET_MAX_IDS = config.getint("BASE", "mget_max_ids", fallback=1000)
+_BULK_MAX_ITEMS = config.getint("BASE", "bulk_max_items", fallback=1000)
+
 
 
 # DOC STATUS NAMES
@@ -28,57 +34,163 @@ class DocStatus(Enum):
 
 # HELPER METHODS
 
-def find_all(page, user_info):
-    """Returns all documents, 1000 at a time. Fow now, it's admin only.
-    "page" allows pagination for more docs, with a max of 10k results"""
-
-    # Check the user group -- only admins allowed for now
+def _is_admin(user_info):
+    """Whether the user belongs to the admin group"""
     groups = get_groups(user_info)
     groups = [group['idmGroupId'] for group in groups]
     admin_group = config.get("ADMIN", "admin_group", fallback=None)
-    if admin_group is None or admin_group not in groups:
+    return admin_group is not None and admin_group in groups
+
+
+def _check_admin(user_info, query_name):
+    """Raise unless the user belongs to the admin group"""
+    if not _is_admin(user_info):
         raise HTTPException(
             status_code=401,
-            detail="Only members of the admin group may use the list query")
-            
-    # Now perform a match_all query with the appropriate page
-    repo = get_repo()()
-    results = repo.find(page=page)
-
-    return results
+            detail=f"Only members of the admin group may use the {query_name} query")
 
 
-def find(filters, user_info):
-    """Construct a search using the elasticsearch DSL
-    # For now, we're just doing a filter--"and" join all search parameters"""
+def _find_groups(filters, user_info):
+    """Check the filters, and get the groups whose docs the user is allowed to see"""
     for tag in filters:
-        val = filters[tag]
-        if not isinstance(
-                val,
-                str) and not isinstance(
-                val,
-                int) and not isinstance(
-                val,
-                float):
-            raise HTTPException(
-                status_code=400,
-                detail="filters field must map a string to a string, int, or float")
+        filter_conditions(filters[tag]) # Raises if the value isn't a plain value or valid operators
 
     # user can only see docs if they match the group
     groups = get_groups(user_info)
     groups = [group['idmGroupId'] for group in groups]
     groups.append(user_info["username"])  # sso is a valid "group"
+    return groups
+
+
+async def find_all(cursor, user_info):
+    """Returns all documents, a page at a time. Fow now, it's admin only.
+    "cursor" is None for the first page, and afterwards the cursor returned by the previous page"""
+
+    # Check the user group -- only admins allowed for now
+    _check_admin(user_info, "list")
+            
+    # Now perform a match_all query, picking up where the cursor left off
+    repo = async_repo()
+    with _metrics.stage("repo_read"):
+        results, next_cursor = await repo.find_page(cursor=cursor)
+    _profiling.annotate(rows=len(results))
+
+    return {"metasheets": results, "cursor": next_cursor}
 
-    repo = get_repo()()
-    results = repo.find(filters, groups)
+
+def iter_all(user_info):
+    """Like find_all, but returns an async generator over every document rather than a single page.
+    All checks happen before this returns, so nothing is raised once a response is streaming"""
+    _check_admin(user_info, "list")
+
+    repo = async_repo()
+    return repo.iter_find()
+
+
+async def find(filters, user_info, fields=None):
+    """Construct a search using the elasticsearch DSL
+    # For now, we're just doing a filter--"and" join all search parameters
+    # If fields is given, each result only carries those fields"""
+    groups = _find_groups(filters, user_info)
+
+    # Identical searches are often repeated, so try the cache first
+    cache_key = _findcache.make_key(filters, groups, fields)
+    results = await _findcache.get(cache_key)
+    if results is not None:
+        _profiling.annotate(filters=filters, fields=fields, rows=len(results), cached=True)
+        return results
+    read_version = await _findcache.version()
+
+    repo = async_repo()
+    with _metrics.stage("repo_read"):
+        if fields is None:
+            results = await repo.find(filters, groups)
+        else:
+            results = await repo.find(filters, groups, fields=fields)
+    _profiling.annotate(filters=filters, fields=fields, rows=len(results), cached=False)
+    _findcache.put(cache_key, read_version, results)
 
     return results
 
 
-def create_doc(notate_body, user_info):
+def iter_find(filters, user_info, fields=None):
+    """Like find, but returns an async generator over every matching document rather than a single page.
+    All checks happen before this returns, so nothing is raised once a response is streaming"""
+    groups = _find_groups(filters, user_info)
+
+    repo = async_repo()
+    repo.validate(filters, groups) # Raise bad filters now, rather than partway through the response
+    if fields is None:
+        return repo.iter_find(filters, groups)
+    return repo.iter_find(filters, groups, fields=fields)
+
+
+async def create_doc(notate_body, user_info):
     """Add a document to the repo
     For a first draft, we're assuming every doc corresponds to an s3 file
     So we need to fill in our fields for a DT4D s3 metasheet, and then add to elasticsearch"""
+    metasheet = _build_doc(notate_body, user_info)
+
+    repo = async_repo()
+    try:
+        with _metrics.stage("repo_write"):
+            await repo.notate(metasheet)
+    finally:
+        await _findcache.invalidate()
+
+    ret_val = {'docId': metasheet['docId']}
+
+    return ret_val
+
+
+async def create_docs(notate_bodies, user_info):
+    """Add many documents to the repo at once. Each one is validated on its own, and the valid
+    ones are handed to the repo in a single batch. Returns a result per item, in order, with
+    either the new docId or the error that kept it out"""
+    if len(notate_bodies) > _BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {_BULK_MAX_ITEMS} items may be notated at once")
+    results = []
+    metasheets = []
+    for notate_body in notate_bodies:
+        if notate_body.docId is not None:
+            results.append({"docId": notate_body.docId, "status_code": 400,
+                            "detail": "bulkNotate only creates documents, docId must not be included"})
+            continue
+        try:
+            metasheet = _build_doc(notate_body, user_info)
+        except HTTPException as exc:
+            results.append({"docId": None, "status_code": exc.status_code, "detail": exc.detail})
+            continue
+        metasheets.append(metasheet)
+        results.append({"docId": metasheet['docId'], "status_code": 200, "detail": None})
+    # Each item's validation was filed under its own classes, but a batch can mix them, so the
+    # write isn't filed under any one
+    _metrics.set_classes("", "")
+
+    if metasheets:
+        try:
+            repo = async_repo()
+            try:
+                with _metrics.stage("repo_write"):
+                    failures = await repo.notate_many(metasheets) or {}
+            finally: # Even a failed batch might have partly gone in
+                await _findcache.invalidate()
+        except HTTPException as exc:
+            # The batch failed as a whole, so every valid item shares the error
+            failures = {metasheet['docId']: exc for metasheet in metasheets}
+        for result in results:
+            exc = failures.get(result["docId"]) if result["status_code"] == 200 else None
+            if exc is not None:
+                result["status_code"] = exc.status_code
+                result["detail"] = exc.detail
+
+    return results
+
+
+def _build_doc(notate_body, user_info):
+    """Construct and validate a new metasheet from a notate body, without storing it"""
 
     doc_id = str(uuid.uuid4())
     metasheet = {}
@@ -103,66 +215,184 @@ def create_doc(notate_body, user_info):
             status_code=400,
             detail="Must include a targetClass")
     metasheet["targetClass"] = notate_body.targetClass
-    meta_target = get_meta_target(notate_body.targetClass)()
-    metasheet['targetMetadata'] = meta_target.validate_target_metadata(
-        notate_body, user_info)
+    with _metrics.stage("resolve"):
+        target = meta_target(notate_body.targetClass)
+    _metrics.set_classes(target_class=notate_body.targetClass)
+    with _metrics.stage("validate_target"):
+        metasheet['targetMetadata'] = target.validate_target_metadata(
+            notate_body, user_info)
 
     if notate_body.siteClass is None:
         raise HTTPException(
             status_code=400,
             detail="Must include a siteClass")
     metasheet["siteClass"] = notate_body.siteClass
-    meta_site = get_meta_site(notate_body.siteClass)()
-    metasheet['siteMetadata'] = meta_site.validate_site_metadata(
-        notate_body, user_info)
+    with _metrics.stage("resolve"):
+        site = meta_site(notate_body.siteClass)
+    _metrics.set_classes(site_class=notate_body.siteClass)
+    with _metrics.stage("validate_site"):
+        metasheet['siteMetadata'] = site.validate_site_metadata(
+            notate_body, user_info)
 
-    repo = get_repo()()
-    repo.notate(metasheet)
+    return metasheet
 
-    ret_val = {'docId': doc_id}
 
-    return ret_val
+def check_profiling(user_info):
+    """Only admins may ask for their request to be profiled. A profile asked for by header
+    only starts once the caller is confirmed to be one"""
+    profile = _profiling.current()
+    if profile is not None and profile.from_header and _is_admin(user_info):
+        _profiling.confirm()
 
 
-def force_notate(metasheet, user_info):
+def set_profiling(sample_rate, user_info):
+    """Set the fraction of this worker's requests that are profiled. Admin only"""
+    _check_admin(user_info, "profiling")
+    if not _profiling.ENABLED:
+        raise HTTPException(
+            status_code=400,
+            detail="Profiling is disabled. Set PROFILING.enabled in the config to use it")
+    if sample_rate is not None:
+        if not 0 <= sample_rate <= 1:
+            raise HTTPException(
+                status_code=400,
+                detail="sampleRate must be between 0 and 1")
+        _profiling.set_sample_rate(sample_rate)
+    return _profiling.settings()
+
+
+def reload(user_info):
+    """Re-scan the site, target and repo modules. Admin only"""
+    _check_admin(user_info, "reloadPlugins")
+    reload_plugins()
+    return ''
+
+
+async def force_notate(metasheet, user_info):
     """Add a document to the repo with no validation"""
 
     # Check the user group -- only admins allowed
-    groups = get_groups(user_info)
-    groups = [group['idmGroupId'] for group in groups]
-    admin_group = config.get("ADMIN", "admin_group", fallback=None)
-    if admin_group is None or admin_group not in groups:
-        raise HTTPException(
-            status_code=401,
-            detail="Only members of the admin group may use the forceNotate query")
+    _check_admin(user_info, "forceNotate")
 
     # If a docId isn't supplied, we have to make one
     doc_id = metasheet.get('docId', str(uuid.uuid4()))
     metasheet['docId'] = doc_id
 
-    repo = get_repo()()
-    repo.notate(metasheet)
+    repo = async_repo()
+    try:
+        with _metrics.stage("repo_write"):
+            await repo.notate(metasheet)
+    finally:
+        await _findcache.invalidate()
 
     ret_val = {'docId': doc_id}
 
     return ret_val
 
 
-def update_doc(notate_body, user_info):
+def _visibility_fields(fields):
+    """ The fields to fetch so a document's visibility can be checked, on top of the ones asked for """
+    if fields is None:
+        return None
+    return list(fields) + ["siteMetadata.tenant", "status"]
+
+
+async def _get_visible(doc_id, user_info, fields=None):
+    """Fetch a single document by id, or None if the user isn't allowed to see it.
+    If fields is given, the document also carries what's needed for the checks"""
+    groups = _find_groups({}, user_info)
+    repo = async_repo()
+    with _metrics.stage("repo_read"):
+        if fields is None:
+            doc = await repo.get(doc_id)
+        else:
+            doc = await repo.get(doc_id, fields=_visibility_fields(fields))
+    if doc is None or doc.get("siteMetadata", {}).get("tenant") not in groups:
+        return None
+    return doc
+
+
+async def get_doc(doc_id, user_info, fields=None):
+    """Fetch a single available document by id, cut down to fields if they're given"""
+    doc = await _get_visible(doc_id, user_info, fields)
+    if doc is None or doc.get("status") != DocStatus.AVAILABLE.value:
+        raise HTTPException(
+            status_code=404,
+            detail="No matching document found")
+    return project(doc, fields)
+
+
+async def get_docs(doc_ids, user_info, fields=None):
+    """Fetch many available documents by id in one call. Ids that don't exist, or that the user
+    isn't allowed to see, are reported as missing so we don't reveal which is which"""
+    if len(doc_ids) > _MGET_MAX_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {_MGET_MAX_IDS} docIds may be fetched at once")
+    groups = _find_groups({}, user_info)
+    repo = async_repo()
+    with _metrics.stage("repo_read"):
+        if fields is None:
+            found = await repo.get_many(doc_ids)
+        else:
+            found = await repo.get_many(doc_ids, fields=_visibility_fields(fields))
+    _profiling.annotate(requested=len(doc_ids), fields=fields, rows=len(found))
+
+    metasheets = [project(doc, fields) for doc in found
+                  if doc.get("siteMetadata", {}).get("tenant") in groups
+                  and doc.get("status") == DocStatus.AVAILABLE.value]
+    returned = {doc["docId"] for doc in metasheets}
+    missing = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id not in returned]
+    return {"metasheets": metasheets, "missing": missing}
+
+
+async def find_docset(doc_set_id, cursor, user_info, fields=None):
+    """Returns the available documents in a docSet that the user can see, a page at a time.
+    "cursor" is None for the first page, and afterwards the cursor returned by the previous page"""
+    filters = {"docSetId": doc_set_id, "status": DocStatus.AVAILABLE.value}
+    groups = _find_groups(filters, user_info)
+    repo = async_repo()
+    with _metrics.stage("repo_read"):
+        if fields is None:
+            results, next_cursor = await repo.find_page(filters, groups, cursor)
+        else:
+            results, next_cursor = await repo.find_page(filters, groups, cursor, fields=fields)
+    _profiling.annotate(docSetId=doc_set_id, fields=fields, rows=len(results))
+
+    return {"metasheets": results, "cursor": next_cursor}
+
+
+async def count_docsets(doc_set_ids, user_info):
+    """Count the available documents the user can see in each docSet, without fetching them"""
+    if len(doc_set_ids) > _MGET_MAX_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {_MGET_MAX_IDS} docSetIds may be counted at once")
+    filters = {"status": DocStatus.AVAILABLE.value}
+    groups = _find_groups(filters, user_info)
+    repo = async_repo()
+    with _metrics.stage("repo_read"):
+        counts = await repo.count_docsets(doc_set_ids, filters, groups)
+    _profiling.annotate(requested=len(doc_set_ids))
+
+    return {"counts": counts}
+
+
+async def update_doc(notate_body, user_info, if_match=None):
     """Given a docId of a previously created document, update it
     # Note that if metadata fields are updated, they're saved in the archive
+    # If if_match is given, the update only goes through if the document's ETag still matches
 
     # First, make sure the document exists and is available to the user"""
     doc_id = notate_body.docId
-    repo = get_repo()()
-    find_filters = {"docId": doc_id}
-    doc = find(find_filters, user_info)
-    if not doc:
+    repo = async_repo()
+    doc = await _get_visible(doc_id, user_info)
+    if doc is None:
         raise HTTPException(
             status_code=404,
             detail="No matching document found")
-    # find returns a list, so extract the doc
-    doc = doc[0]
+    # Fail fast if the caller is already out of date. The repo checks again when it writes
+    check_etag(doc, if_match)
 
     # We found a document, so initialize and construct the query, validating
     # as we go
@@ -200,14 +430,26 @@ def update_doc(notate_body, user_info):
         metadata_archive.append(archive_format)
         update_query["metadataArchive"] = metadata_archive
 
-    meta_target = get_meta_target(doc["targetClass"])()
-    update_query = meta_target.update_target_metadata(
-        doc, notate_body, update_query, archive_format)
-
-    meta_site = get_meta_site(doc["siteClass"])()
-    update_query = meta_site.update_site_metadata(
-        doc, notate_body, update_query, archive_format)
-
-    repo.update(doc_id, update_query)
+    with _metrics.stage("resolve"):
+        target = meta_target(doc["targetClass"])
+        site = meta_site(doc["siteClass"])
+    _metrics.set_classes(doc["targetClass"], doc["siteClass"])
+
+    with _metrics.stage("validate_target"):
+        update_query = target.update_target_metadata(
+            doc, notate_body, update_query, archive_format)
+
+    with _metrics.stage("validate_site"):
+        update_query = site.update_site_metadata(
+            doc, notate_body, update_query, archive_format)
+
+    try:
+        with _metrics.stage("repo_write"):
+            if if_match is None:
+                await repo.update(doc_id, update_query)
+            else:
+                await repo.update(doc_id, update_query, if_match=if_match)
+    finally:
+        await _findcache.invalidate()
 
     return ''
@@ -0,0 +1,180 @@
+""" Latency histograms for each stage of handling a request (auth, plugin lookup, validation, the
+repo call, and the request as a whole), served in Prometheus text format at /metrics. Each stage
+is also reported back to the client in a Server-Timing header.
+
+Recording a stage is a perf_counter call on each side and a few additions under a lock, so this
+is cheap enough to leave on. Histograms are per process, so with several uvicorn workers each
+scrape sees one worker's numbers """
+
+import bisect
+import configparser
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+config = configparser.ConfigParser()
+config.read('metarepo.conf')
+
+_ENABLED = config.getboolean('METRICS', 'enabled', fallback=True)
+_SERVER_TIMING = config.getboolean('METRICS', 'server_timing', fallback=True)
+_REPO = config.get('BASE', 'repotype', fallback='')
+
+# Upper bounds of each bucket, in seconds
+_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_LABELS = ("stage", "endpoint", "repo", "target_class", "site_class")
+
+_histograms = {} # label values -> [count per bucket (the last is +Inf), sum, count]
+_histograms_lock = threading.Lock()
+
+
+class _RequestTimings:
+    """ What one request has recorded so far, and the labels its stages are filed under """
+    __slots__ = ("endpoint", "target_class", "site_class", "timings")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.target_class = ""
+        self.site_class = ""
+        self.timings = [] # (stage, seconds), in the order they finished
+
+_request = contextvars.ContextVar("metarepo_request_timings", default=None)
+
+
+def _observe(labels, seconds):
+    """ Add one observation to a histogram """
+    bucket = bisect.bisect_left(_BUCKETS, seconds)
+    with _histograms_lock:
+        histogram = _histograms.get(labels)
+        if histogram is None:
+            histogram = _histograms[labels] = [[0] * (len(_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bucket] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+def record(stage_name, seconds):
+    """ Record a stage that was timed some other way """
+    if not _ENABLED:
+        return
+    request = _request.get()
+    if request is None:
+        labels = (stage_name, "", _REPO, "", "")
+    else:
+        labels = (stage_name, request.endpoint, _REPO, request.target_class, request.site_class)
+        request.timings.append((stage_name, seconds))
+    _observe(labels, seconds)
+
+
+@contextmanager
+def stage(stage_name):
+    """ Time a block as one stage of the current request """
+    if not _ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage_name, time.perf_counter() - start)
+
+
+def set_classes(target_class=None, site_class=None):
+    """ File the current request's later stages under a target and site class. Only call this
+    once the class is known to exist, so made up names can't blow up the number of series """
+    request = _request.get()
+    if request is None:
+        return
+    if target_class is not None:
+        request.target_class = target_class
+    if site_class is not None:
+        request.site_class = site_class
+
+
+def _server_timing(timings):
+    return ", ".join(f"{name};dur={seconds*1000:.3f}" for name, seconds in timings)
+
+
+class MetricsMiddleware:
+    """ A plain ASGI middleware, to keep the per request cost down. It sets up the request's
+    timings, adds the Server-Timing header once the endpoint has run, and records the total.
+    endpoint_name maps a request's scope to a low cardinality name, like its route's path """
+
+    def __init__(self, app, endpoint_name):
+        self.app = app
+        self.endpoint_name = endpoint_name
+
+    async def __call__(self, scope, receive, send):
+        if not _ENABLED or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = _RequestTimings(self.endpoint_name(scope))
+        token = _request.set(request)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and _SERVER_TIMING:
+                elapsed = time.perf_counter() - start
+                header = _server_timing(request.timings + [("total", elapsed)])
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request.reset(token)
+            _observe(("total", request.endpoint, _REPO, request.target_class, request.site_class),
+                     time.perf_counter() - start)
+
+
+def _format_labels(labels, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(_LABELS, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """ Every histogram, in Prometheus text exposition format """
+    with _histograms_lock:
+        snapshot = [(labels, list(histogram[0]), histogram[1], histogram[2])
+                    for labels, histogram in sorted(_histograms.items())]
+    lines = ["# HELP metarepo_stage_seconds Time spent in each stage of handling a request",
+             "# TYPE metarepo_stage_seconds histogram"]
+    for labels, buckets, total, count in snapshot:
+        cumulative = 0
+        for bound, bucket_count in zip(_BUCKETS + (float("inf"),), buckets):
+            cumulative += bucket_count
+            le_label = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+            lines.append(f"metarepo_stage_seconds_bucket{_format_labels(labels, le_label)} {cumulative}")
+        lines.append(f"metarepo_stage_seconds_sum{_format_labels(labels)} {total}")
+        lines.append(f"metarepo_stage_seconds_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+# Cache statistics that are a current level rather than a running count
+_GAUGE_STATS = ("size", "bytes")
+
+def render_stats(prefix, description, stats):
+    """ A dict of counters, like a cache's cache_stats(), in Prometheus text format. Each becomes
+    <prefix>_<name>_total, except levels like size, which are gauges named <prefix>_<name> """
+    lines = []
+    for name, value in sorted(stats.items()):
+        if name in _GAUGE_STATS:
+            metric, metric_type = f"{prefix}_{name}", "gauge"
+        else:
+            metric, metric_type = f"{prefix}_{name}_total", "counter"
+        lines.append(f"# HELP {metric} {description}: {name}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    """ Drop every histogram """
+    with _histograms_lock:
+        _histograms.clear()
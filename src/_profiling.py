@@ -0,0 +1,277 @@
+""" On demand profiling of single requests, for finding out why one particular request is slow
+against real data.
+
+An admin can ask for a request to be profiled with the X-Metarepo-Profile header, or have a
+fraction of all requests profiled by setting a sample rate at runtime through admin/profiling.
+A profile asked for by header is only provisional until the caller is confirmed to be an admin
+(see confirm), so nobody else can start one, take a profiling slot or have anything written.
+A profiled request is watched by a sampling profiler thread, which records the request's stack
+every few milliseconds, both on the event loop and in any thread running repo calls for it.
+Samples from other requests sharing the event loop are left out. Each profile is written to a
+directory as pstats, collapsed stacks (for flame graphs) and a JSON file of what the request
+did, such as its normalized filters and how many rows it returned. Only the newest profiles are
+kept.
+
+Nothing here is installed unless PROFILING.enabled is set, and when it is, a request that isn't
+profiled costs one header check and one comparison """
+
+import configparser
+import contextvars
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+
+config = configparser.ConfigParser()
+config.read('metarepo.conf')
+
+ENABLED = config.getboolean('PROFILING', 'enabled', fallback=False)
+_DIRECTORY = config.get('PROFILING', 'directory', fallback='profiles')
+_KEEP = config.getint('PROFILING', 'keep', fallback=50)
+_INTERVAL = config.getfloat('PROFILING', 'interval', fallback=0.005)
+_MAX_SECONDS = config.getfloat('PROFILING', 'max_seconds', fallback=60)
+_MAX_CONCURRENT = config.getint('PROFILING', 'max_concurrent', fallback=1)
+
+_HEADER = b"x-metarepo-profile"
+_FORMATS = (".pstats", ".folded", ".json")
+
+_sample_rate = config.getfloat('PROFILING', 'sample_rate', fallback=0.0)
+_active = 0 # Profiles currently running in this worker
+_active_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+_current = contextvars.ContextVar("metarepo_profile", default=None)
+
+
+class _Profile:
+    """ One request being profiled. A sampler thread records the stacks of every thread in
+    roots, from its root frame up, until stop() is called, then writes the profile out.
+    A profile asked for by header isn't started until confirm() """
+
+    def __init__(self, endpoint, from_header, root):
+        self.profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        self.from_header = from_header
+        self.info = {"method": endpoint[0], "path": endpoint[1], "fromHeader": from_header}
+        self.roots = {} # thread id -> the frame the request's work starts at on that thread
+        self.stacks = {} # tuple of code locations, outermost first -> number of samples
+        self.samples = 0
+        self.root = root # Where the request's work starts on the event loop
+        self.started = False
+        self.start_time = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True,
+                                         name=f"profiler-{self.profile_id}")
+
+    def start(self):
+        """ Start sampling. Call from the event loop thread the request is running on """
+        self.roots[threading.get_ident()] = self.root
+        self.start_time = time.perf_counter()
+        self.started = True
+        self._thread.start()
+
+    def stop(self):
+        self.info["seconds"] = time.perf_counter() - self.start_time
+        self._stopped.set()
+
+    def _sample(self):
+        deadline = time.perf_counter() + _MAX_SECONDS
+        while not self._stopped.wait(_INTERVAL):
+            if time.perf_counter() > deadline:
+                self.info["truncated"] = True
+                break
+            frames = sys._current_frames() # pylint: disable=protected-access
+            for thread_id, root in list(self.roots.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and frame is not root:
+                    stack.append(_location(frame.f_code))
+                    frame = frame.f_back
+                if frame is None: # The thread is busy with something other than this request
+                    continue
+                stack.append(_location(root.f_code))
+                stack = tuple(reversed(stack))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+        self._stopped.wait() # Don't write until the request has finished adding to info
+        try:
+            self._finish()
+        finally:
+            _release()
+
+    def _finish(self):
+        self.info["samples"] = self.samples
+        self.info["interval"] = _INTERVAL
+        with _write_lock:
+            os.makedirs(_DIRECTORY, exist_ok=True)
+            base = os.path.join(_DIRECTORY, self.profile_id)
+            pstats.Stats(_SampledStats(self.stacks, _INTERVAL)).dump_stats(base + ".pstats")
+            with open(base + ".folded", "w", encoding="utf-8") as fout:
+                for stack, count in sorted(self.stacks.items()):
+                    fout.write(";".join(_folded_name(location) for location in stack) + f" {count}\n")
+            with open(base + ".json", "w", encoding="utf-8") as fout:
+                json.dump(self.info, fout, indent=2, sort_keys=True, default=str)
+            _rotate()
+
+
+def _location(code):
+    """ How pstats identifies a function """
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+def _folded_name(location):
+    filename, line, name = location
+    return f"{name} ({filename}:{line})".replace(";", ":")
+
+
+class _SampledStats:
+    """ Turns samples into the stats pstats expects from a profiler. Times are estimates (the
+    number of samples times the interval), and call counts are sample counts """
+
+    def __init__(self, stacks, interval):
+        self.stacks = stacks
+        self.interval = interval
+        self.stats = {}
+
+    def create_stats(self):
+        stats = {} # location -> [samples, samples, own time, cumulative time, callers]
+        for stack, count in self.stacks.items():
+            seconds = count * self.interval
+            for location in set(stack): # Recursion only counts once toward cumulative time
+                entry = stats.setdefault(location, [0, 0, 0.0, 0.0, {}])
+                entry[0] += count
+                entry[1] += count
+                entry[3] += seconds
+            stats[stack[-1]][2] += seconds
+            for caller, callee in zip(stack, stack[1:]):
+                callers = stats[callee][4]
+                calls, _, own, cumulative = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (calls + count, calls + count,
+                                   own + (seconds if callee == stack[-1] else 0.0), cumulative + seconds)
+        self.stats = {location: tuple(entry) for location, entry in stats.items()}
+
+
+def _rotate():
+    """ Delete all but the newest _KEEP profiles. Must be called with _write_lock held """
+    profiles = sorted({name.rsplit(".", 1)[0] for name in os.listdir(_DIRECTORY)
+                       if name.endswith(_FORMATS)})
+    for profile_id in profiles[:max(len(profiles) - _KEEP, 0)]:
+        for extension in _FORMATS:
+            try:
+                os.remove(os.path.join(_DIRECTORY, profile_id + extension))
+            except FileNotFoundError:
+                pass
+
+
+def _wants_profile(scope):
+    """ Whether a request asked to be profiled, or was picked by the sample rate """
+    for name, value in scope.get("headers", ()):
+        if name == _HEADER:
+            return value.lower() in (b"1", b"true", b"yes"), True
+    return _sample_rate > 0 and random.random() < _sample_rate, False
+
+
+def _reserve():
+    """ Take a slot for a profile, if there's one free """
+    global _active # pylint: disable=global-statement
+    with _active_lock:
+        if _active >= _MAX_CONCURRENT:
+            return False
+        _active += 1
+        return True
+
+def _release():
+    global _active # pylint: disable=global-statement
+    with _active_lock:
+        _active -= 1
+
+
+class ProfilingMiddleware:
+    """ A plain ASGI middleware that profiles the requests that ask for it, and tells the client
+    the profile's id in an X-Metarepo-Profile-Id header. Only installed if PROFILING.enabled """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        wanted, from_header = _wants_profile(scope)
+        # A sampled profile starts straight away. One asked for by header waits for confirm()
+        if not wanted or (not from_header and not _reserve()):
+            await self.app(scope, receive, send)
+            return
+
+        profile = _Profile((scope.get("method"), scope.get("path")), from_header,
+                           sys._getframe()) # pylint: disable=protected-access
+        token = _current.set(profile)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start" and profile.started:
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-metarepo-profile-id", profile.profile_id.encode("latin-1"))]
+            await send(message)
+
+        if not from_header:
+            profile.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        except Exception as exc:
+            profile.info["error"] = repr(exc)
+            raise
+        finally:
+            _current.reset(token)
+            if profile.started: # Otherwise it was never confirmed, and there's nothing to write
+                profile.stop()
+
+
+def current():
+    """ The profile of the request being handled, or None """
+    return _current.get()
+
+
+def confirm():
+    """ Start the current request's profile, if it was asked for by header and is still waiting.
+    Call once the caller is known to be an admin. If every profiling slot is taken, the request
+    just isn't profiled """
+    profile = _current.get()
+    if profile is not None and not profile.started and _reserve():
+        profile.start()
+
+
+def annotate(**info):
+    """ Attach details (filters, row counts, and so on) to the current request's profile, if it has one """
+    profile = _current.get()
+    if profile is not None:
+        profile.info.update(info)
+
+
+def in_thread(func):
+    """ Wraps a function about to be run in another thread for the current request, so that the
+    thread is profiled along with the request. Returns func unchanged if it isn't being profiled """
+    profile = _current.get()
+    if profile is None or not profile.started:
+        return func
+
+    def profiled(*args, **kwargs):
+        thread_id = threading.get_ident()
+        profile.roots[thread_id] = sys._getframe() # pylint: disable=protected-access
+        try:
+            return func(*args, **kwargs)
+        finally:
+            del profile.roots[thread_id]
+    return profiled
+
+
+def settings():
+    """ This worker's profiling settings """
+    return {"enabled": ENABLED, "sampleRate": _sample_rate, "directory": os.path.abspath(_DIRECTORY)}
+
+
+def set_sample_rate(sample_rate):
+    """ Profile this fraction of this worker's requests, from 0 (none) to 1 (all) """
+    global _sample_rate # pylint: disable=global-statement
+    _sample_rate = sample_rate
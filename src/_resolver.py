@@ -1,39 +1,163 @@
 """The resolver provides two external functions--getMetaSite and getMetaTarget
 Given the name of a Site or Target type, provide a corresponding class
-These modules are in a separate module so that a user can easily subsitute their own"""
+These modules are in a separate module so that a user can easily subsitute their own
+
+Every module in MetaSites/, MetaTargets/ and Repository/ is imported and checked once, the first
+time anything is resolved (metarepo.py does this at startup), and lookups after that are just a
+dict access. Instances are cached too, since sites, targets and repos don't keep per request
+state. Call reload_plugins() to pick up new or changed modules without a restart"""
 
 import configparser
 import importlib
+import os
+import threading
 
 from fastapi import HTTPException
 
+from . import _profiling
+
 config = configparser.ConfigParser()
 config.read('metarepo.conf')
 
+# Each plugin directory, the name of the module holding its base class, and that class's name
+_PLUGIN_TYPES = {
+    'MetaSites': ('MetaSiteBase', 'MetaSiteBase'),
+    'MetaTargets': ('MetaTargetBase', 'MetaTargetBase'),
+    'Repository': ('RepositoryBase', 'RepoBase'),
+}
+
+_registry = None # plugin directory -> {name: class}
+_instances = {} # (plugin directory, name) -> instance
+_async_repo = None # Built once, since it might be a generated adapter class
+_registry_lock = threading.RLock()
+
+
+def _discover(meta_type_cls, reload):
+    """ Import every module in a plugin directory, keeping the ones that hold a same named
+    subclass of the directory's base class """
+    base_module_name, base_name = _PLUGIN_TYPES[meta_type_cls]
+    base_module = importlib.import_module(f"{meta_type_cls}.{base_module_name}")
+    base_class = getattr(base_module, base_name)
+
+    plugin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), meta_type_cls)
+    classes = {}
+    for filename in sorted(os.listdir(plugin_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext != '.py' or name == base_module_name or name.startswith('_'):
+            continue
+        try:
+            meta_module = importlib.import_module(f"{meta_type_cls}.{name}")
+            # Repos hold connections and process-wide state in their modules, so only new ones
+            # are picked up. Reloading one that's in use would orphan all of that
+            if reload and meta_type_cls != 'Repository':
+                meta_module = importlib.reload(meta_module)
+        except Exception as exc: # A broken plugin shouldn't take the others down with it
+            print(f"Could not load {meta_type_cls}.{name}: {exc}")
+            continue
+        meta_class = getattr(meta_module, name, None)
+        if not isinstance(meta_class, type) or not issubclass(meta_class, base_class):
+            print(f"Skipping {meta_type_cls}.{name}: no {name} class inheriting from {base_name}")
+            continue
+        classes[name] = meta_class
+    return classes
+
+
+def load_plugins(reload=False):
+    """ Discover and validate every plugin, and make sure the configured repotype is one of them """
+    global _registry, _async_repo # pylint: disable=global-statement
+    with _registry_lock:
+        registry = {meta_type_cls: _discover(meta_type_cls, reload) for meta_type_cls in _PLUGIN_TYPES}
+
+        db_type = config.get("BASE", "repotype", fallback=None)
+        if db_type not in registry['Repository']:
+            raise RuntimeError(f"BASE.repotype {db_type} is not an available repo. "
+                               f"Options are: {', '.join(registry['Repository'])}")
+
+        _registry = registry
+        _instances.clear()
+        _async_repo = None
+
+
+def reload_plugins():
+    """ Re-scan the plugin directories, picking up new modules and reloading existing sites and targets """
+    load_plugins(reload=True)
+
+
 def _get_meta(meta_type_cls, meta_type_str, name):
-    """ Perform a dynamic import from one of our subdirectories """
-    try:
-        meta_module = importlib.import_module(f"{meta_type_cls}.{name}")
-        meta_class = getattr(meta_module, name)
-    except Exception as exc:
-        print(exc)
+    """ Look up one of our plugins by name """
+    if _registry is None:
+        load_plugins()
+    meta_class = _registry[meta_type_cls].get(name)
+    if meta_class is None:
         raise HTTPException(status_code=400,
-                            detail=f"Nonexistent {meta_type_str} type: {name}") from exc
+                            detail=f"Nonexistent {meta_type_str} type: {name}")
     return meta_class
 
+def _get_instance(meta_type_cls, meta_type_str, name):
+    """ Get the shared instance of one of our plugins """
+    key = (meta_type_cls, name)
+    instance = _instances.get(key)
+    if instance is None:
+        meta_class = _get_meta(meta_type_cls, meta_type_str, name)
+        with _registry_lock:
+            instance = _instances.setdefault(key, meta_class())
+    return instance
+
 def get_meta_site(name):
-    """ Dynamically import a site given a string name """
+    """ Get a site class given a string name """
     meta_class = _get_meta('MetaSites', 'site', name)
     return meta_class
 
 def get_meta_target(name):
-    """ Dynamically import a target given a string name """
+    """ Get a target class given a string name """
     meta_class = _get_meta('MetaTargets', 'target', name)
     return meta_class
 
+def meta_site(name):
+    """ Get the shared instance of a site given a string name """
+    return _get_instance('MetaSites', 'site', name)
+
+def meta_target(name):
+    """ Get the shared instance of a target given a string name """
+    return _get_instance('MetaTargets', 'target', name)
+
 
 def get_repo():
-    """ Dynamically get the appropriate repo """
+    """ Get the appropriate repo """
     db_type = config.get("BASE", "repotype", fallback=None)
     meta_class = _get_meta('Repository', 'repo', db_type)
     return meta_class
+
+def get_async_repo():
+    """ Get the async version of the repo. Repos can provide their own by defining
+    Async<repotype> in their module, otherwise the sync repo gets run in a threadpool """
+    global _async_repo # pylint: disable=global-statement
+    if _async_repo is None:
+        db_type = config.get("BASE", "repotype", fallback=None)
+        repo_class = get_repo()
+        repo_module = importlib.import_module(repo_class.__module__)
+        async_class = getattr(repo_module, f"Async{db_type}", None)
+        if async_class is None:
+            base_module = importlib.import_module("Repository.RepositoryBase")
+            async_class = type(f"Async{db_type}", (base_module.AsyncRepoAdapter,),
+                               {"repo_class": repo_class})
+        _async_repo = async_class
+    return _async_repo
+
+def repo():
+    """ Get the shared instance of the repo """
+    db_type = config.get("BASE", "repotype", fallback=None)
+    return _get_instance('Repository', 'repo', db_type)
+
+def async_repo():
+    """ Get the shared instance of the async repo """
+    key = ('Repository', 'async')
+    instance = _instances.get(key)
+    if instance is None:
+        async_class = get_async_repo()
+        instance = async_class()
+        if _profiling.ENABLED and hasattr(instance, "call_wrapper"):
+            instance.call_wrapper = _profiling.in_thread
+        with _registry_lock:
+            instance = _instances.setdefault(key, instance)
+    return instance
@@ -1,27 +1,225 @@
 """ Authentication helper methods for MetaRepo2, assuming IDM """
 
+import asyncio
 import configparser
+import hashlib
+import threading
 import time
+from collections import OrderedDict
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 
 from fastapi import HTTPException
 
 config = configparser.ConfigParser()
 config.read('metarepo.conf')
 
+# Validated tokens are cached so that we don't have to hit the auth service on every request.
+# Entries are keyed by a hash of the token (we never keep the raw token around) and are evicted
+# at whichever comes first: the expiresAt returned by the auth service, or cache_ttl seconds
+_CACHE_SIZE = config.getint('AUTHSERVICE', 'cache_size', fallback=1024)
+_CACHE_TTL = config.getfloat('AUTHSERVICE', 'cache_ttl', fallback=300)
+_POOL_SIZE = config.getint('AUTHSERVICE', 'pool_size', fallback=10)
+_TIMEOUT = config.getfloat('AUTHSERVICE', 'timeout', fallback=10)
+
+_cache = OrderedDict() # token hash -> (user_info, evict_at), in LRU order
+_cache_lock = threading.Lock()
+_inflight = {} # token hash -> _PendingAuth, so concurrent lookups share one outbound call
+_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+_session = None
+_session_lock = threading.Lock()
+
+# The async path has its own pooled client, and coalesces with futures instead of events
+_async_client = None
+_inflight_async = {} # token hash -> asyncio.Future
+
+
+class _PendingAuth:
+    """ A lookup that's currently in flight. Followers wait on the event and read the result """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+def _get_session():
+    """ One pooled, keep-alive session per process, created on first use """
+    global _session # pylint: disable=global-statement
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                ses = requests.Session()
+                adapter = HTTPAdapter(pool_connections=_POOL_SIZE, pool_maxsize=_POOL_SIZE)
+                ses.mount('http://', adapter)
+                ses.mount('https://', adapter)
+                _session = ses
+    return _session
+
+
+def _get_async_client():
+    """ One pooled, keep-alive async client per process, created on first use """
+    global _async_client # pylint: disable=global-statement
+    if _async_client is None:
+        limits = httpx.Limits(max_connections=_POOL_SIZE, max_keepalive_connections=_POOL_SIZE)
+        _async_client = httpx.AsyncClient(limits=limits, timeout=_TIMEOUT)
+    return _async_client
+
+
+async def close_async_client():
+    """ Close the async client, if one was created """
+    global _async_client # pylint: disable=global-statement
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _token_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _evict_at(user_info):
+    """ Figure out when a cached login must be dropped. expiresAt is in ms """
+    evict_at = time.time() + _CACHE_TTL
+    try:
+        evict_at = min(evict_at, int(user_info["expiresAt"]) / 1000)
+    except (KeyError, TypeError, ValueError):
+        pass
+    return evict_at
+
+
+def _cache_get(key):
+    """ Look up a cached login. Must be called with _cache_lock held """
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    user_info, evict_at = entry
+    if evict_at <= time.time():
+        del _cache[key]
+        return None
+    _cache.move_to_end(key)
+    return user_info
+
+
+def _cache_put(key, user_info):
+    """ Store a login. Must be called with _cache_lock held """
+    if _CACHE_SIZE <= 0:
+        return
+    evict_at = _evict_at(user_info)
+    if evict_at <= time.time():
+        return # Already expired, no point caching it
+    _cache[key] = (user_info, evict_at)
+    _cache.move_to_end(key)
+    while len(_cache) > _CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _check_auth_service(token):
+    """ Actually ask the auth service who owns a token """
+    url = config.get('AUTHSERVICE', 'admin_url') + config.get('AUTHSERVICE', 'checkAuth_endpoint')
+    res = _get_session().post(url, headers={"Authorization": token}, timeout=_TIMEOUT)
+    if res.status_code == 200:
+        return res.json()
+    return None
+
+
 def authenticate(token):
     """ Given a token, get the associated user """
     if token is None:
         return None
     if not token.startswith("Bearer "): # Make sure our bearer token starts with the prefix
         token = "Bearer " + token
+    key = _token_key(token)
+
+    with _cache_lock:
+        user_info = _cache_get(key)
+        if user_info is not None:
+            _stats["hits"] += 1
+            return user_info
+        _stats["misses"] += 1
+        pending = _inflight.get(key)
+        leader = pending is None
+        if leader:
+            pending = _PendingAuth()
+            _inflight[key] = pending
+        else:
+            _stats["coalesced"] += 1
+
+    if not leader:
+        pending.event.wait()
+        return pending.result
+
+    try:
+        pending.result = _check_auth_service(token)
+    finally:
+        with _cache_lock:
+            if pending.result is not None:
+                _cache_put(key, pending.result)
+            del _inflight[key]
+        pending.event.set()
+    return pending.result
+
+
+async def _check_auth_service_async(token):
+    """ Actually ask the auth service who owns a token, without blocking the event loop """
     url = config.get('AUTHSERVICE', 'admin_url') + config.get('AUTHSERVICE', 'checkAuth_endpoint')
-    ses = requests.session()
-    res = ses.post(url, headers={"Authorization": token})
+    res = await _get_async_client().post(url, headers={"Authorization": token})
     if res.status_code == 200:
         return res.json()
     return None
 
+
+async def authenticate_async(token):
+    """ The same as authenticate, for async endpoints. Shares its cache and counters """
+    if token is None:
+        return None
+    if not token.startswith("Bearer "): # Make sure our bearer token starts with the prefix
+        token = "Bearer " + token
+    key = _token_key(token)
+
+    with _cache_lock:
+        user_info = _cache_get(key)
+        if user_info is not None:
+            _stats["hits"] += 1
+            return user_info
+        _stats["misses"] += 1
+
+    pending = _inflight_async.get(key)
+    if pending is not None:
+        with _cache_lock:
+            _stats["coalesced"] += 1
+        return await asyncio.shield(pending)
+
+    pending = asyncio.get_running_loop().create_future()
+    _inflight_async[key] = pending
+    result = None
+    try:
+        result = await _check_auth_service_async(token)
+    finally:
+        # Like the sync path, if the call failed then anyone waiting on it gets no user
+        with _cache_lock:
+            if result is not None:
+                _cache_put(key, result)
+        del _inflight_async[key]
+        pending.set_result(result)
+    return result
+
+
+def cache_stats():
+    """ Hit/miss counters for the token cache """
+    with _cache_lock:
+        stats = dict(_stats)
+        stats["size"] = len(_cache)
+    return stats
+
+
+def clear_cache():
+    """ Drop every cached login, for example after a permissions change """
+    with _cache_lock:
+        _cache.clear()
+
+
 def get_groups(user_info):
     """ Get a list of groups belong to an authenticated user """
     if user_info is None:
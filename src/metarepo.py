@@ -1,16 +1,45 @@
 """ The basic API for the Meta Repo. This file should never contain much more
 than is needed to understand each endpoint's inputs and output """
 
+import json
 from typing import List, Union
-from fastapi import FastAPI, Header
+from fastapi import FastAPI, Header, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from starlette.routing import Match
 
-from . import _metaImpl
+from . import _findcache, _metaImpl, _metrics, _profiling
 
-from .auth import authenticate, check_authorization
+from .auth import authenticate_async, cache_stats, check_authorization, close_async_client
+from ._resolver import get_async_repo, get_repo, load_plugins
+from .Repository.RepositoryBase import metasheet_etag
 
 app = FastAPI()
 
+def _endpoint_name(scope):
+    """ Label a request's metrics with its route's path, so /doc/{docId} is one series not one per doc """
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+app.add_middleware(_metrics.MetricsMiddleware, endpoint_name=_endpoint_name)
+if _profiling.ENABLED:
+    app.add_middleware(_profiling.ProfilingMiddleware)
+
+@app.on_event("startup")
+def startup():
+    """ Load every site, target and repo up front, failing fast if the config is wrong """
+    load_plugins()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """ Let the repo close any connections it's holding """
+    get_repo().close()
+    await get_async_repo().aclose()
+    await close_async_client()
+
 ### REQUEST BODY STRUCTURES
 
 # The following line is an instruction to "pylint" so devs don't get errors
@@ -27,53 +56,175 @@ class NotateBody(BaseModel):
     targetMetadata: Union[dict, None] = None
     archiveComment: Union[str, None] = None
 
+class MgetBody(BaseModel):
+    docIds: List[str]
+    fields: Union[List[str], None] = None
+
 class FindBody(BaseModel):
     filters: dict = {}
+    fields: Union[List[str], None] = None
+
+class DocSetCountBody(BaseModel):
+    docSetIds: List[str]
+
+class ProfilingBody(BaseModel):
+    sampleRate: Union[float, None] = None
+
+NDJSON = "application/x-ndjson"
+
+def _wants_stream(stream, accept):
+    """ Streaming is opt in, with either ?stream=true or an NDJSON Accept header """
+    return stream or (accept is not None and NDJSON in accept)
+
+def _stream_ndjson(metasheets):
+    """ Write metasheets out one JSON document per line, as the repo produces them """
+    async def lines():
+        async for metasheet in metasheets:
+            yield json.dumps(metasheet) + "\n"
+    return StreamingResponse(lines(), media_type=NDJSON)
 
 ### API ENDPOINTS
 
+async def _authenticate(authorization):
+    """ Authenticate and authorize the caller, timed as the request's auth stage """
+    with _metrics.stage("auth"):
+        authorization = await authenticate_async(authorization)
+        check_authorization(authorization)
+    _metaImpl.check_profiling(authorization)
+    return authorization
+
+def _strip_etag(etag):
+    """ Turn a header value like W/"abc" into abc """
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    return etag.strip('"')
+
 @app.post("/notate")
-def notate(notate_body: NotateBody,
-         authorization: Union[str, None] = Header(default=None)) -> str:
-    """ Add or update a document within the metarepo """
-    authorization = authenticate(authorization)
-    check_authorization(authorization)
+async def notate(notate_body: NotateBody,
+         authorization: Union[str, None] = Header(default=None),
+         if_match: Union[str, None] = Header(default=None)) -> str:
+    """ Add or update a document within the metarepo. When updating, an If-Match header
+    holding the document's ETag makes the update fail with a 412 if someone else got there first """
+    authorization = await _authenticate(authorization)
 
     if notate_body.docId is None:
-        ret_val = _metaImpl.create_doc(notate_body, authorization)
+        ret_val = await _metaImpl.create_doc(notate_body, authorization)
     else:
-        ret_val = _metaImpl.update_doc(notate_body, authorization)
+        if_match = _strip_etag(if_match) if if_match is not None else None
+        ret_val = await _metaImpl.update_doc(notate_body, authorization, if_match)
 
     return str(ret_val)
 
+@app.get("/doc/{docId}")
+async def get_doc(docId: str, # pylint: disable=invalid-name
+         fields: Union[List[str], None] = Query(default=None),
+         authorization: Union[str, None] = Header(default=None),
+         if_none_match: Union[str, None] = Header(default=None)):
+    """ Fetch a single document by id, with an ETag for conditional requests. The ETag is of
+    the whole document, so it's left out when only some fields are asked for """
+    authorization = await _authenticate(authorization)
+
+    doc = await _metaImpl.get_doc(docId, authorization, fields)
+    if fields is not None:
+        return JSONResponse(doc)
+    etag = metasheet_etag(doc)
+    headers = {"ETag": f'"{etag}"'}
+    if if_none_match is not None:
+        if etag in [_strip_etag(tag) for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+    return JSONResponse(doc, headers=headers)
+
+@app.post("/docs/mget")
+async def mget(mget_body: MgetBody,
+         authorization: Union[str, None] = Header(default=None)) -> dict:
+    """ Fetch many documents by id in one call """
+    authorization = await _authenticate(authorization)
+
+    ret_val = await _metaImpl.get_docs(mget_body.docIds, authorization, mget_body.fields)
+
+    return ret_val
+
+@app.post("/bulkNotate")
+async def bulk_notate(notate_bodies: List[NotateBody],
+         authorization: Union[str, None] = Header(default=None)) -> List[dict]:
+    """ Add many new documents to the metarepo in one call """
+    authorization = await _authenticate(authorization)
+
+    return await _metaImpl.create_docs(notate_bodies, authorization)
+
 @app.get("/find")
-def find(find_body: FindBody,
+async def find(find_body: FindBody, stream: bool = False,
+         accept: Union[str, None] = Header(default=None),
          authorization: Union[str, None] = Header(default=None)) -> List[dict]:
     """ Use filters to find a document within the metarepo """
-    authorization = authenticate(authorization)
-    check_authorization(authorization)
+    authorization = await _authenticate(authorization)
 
     # user can only see available docs
     find_body.filters["status"] = _metaImpl.DocStatus.AVAILABLE.value
 
-    return _metaImpl.find(find_body.filters, authorization)
+    if _wants_stream(stream, accept):
+        return _stream_ndjson(_metaImpl.iter_find(find_body.filters, authorization, find_body.fields))
+    return await _metaImpl.find(find_body.filters, authorization, find_body.fields)
+
+@app.get("/docset/{docSetId}")
+async def find_docset(docSetId: str, cursor: Union[str, None] = None, # pylint: disable=invalid-name
+         fields: Union[List[str], None] = Query(default=None),
+         authorization: Union[str, None] = Header(default=None)) -> dict:
+    """ List the documents in a docSet, a page at a time """
+    authorization = await _authenticate(authorization)
+
+    return await _metaImpl.find_docset(docSetId, cursor, authorization, fields)
+
+@app.post("/docsets/counts")
+async def count_docsets(count_body: DocSetCountBody,
+         authorization: Union[str, None] = Header(default=None)) -> dict:
+    """ Count the documents in each of several docSets, without fetching them """
+    authorization = await _authenticate(authorization)
+
+    return await _metaImpl.count_docsets(count_body.docSetIds, authorization)
 
 @app.get("/admin/find_all")
-def find_all(page: int,
-         authorization: Union[str, None] = Header(default=None)) -> List[dict]:
-    """ Admin only: list all documents within the metarepo """
-    authorization = authenticate(authorization)
-    check_authorization(authorization)
+async def find_all(cursor: Union[str, None] = None, stream: bool = False,
+         accept: Union[str, None] = Header(default=None),
+         authorization: Union[str, None] = Header(default=None)) -> dict:
+    """ Admin only: list all documents within the metarepo, a page at a time """
+    authorization = await _authenticate(authorization)
 
-    return _metaImpl.find_all(page, authorization)
+    if _wants_stream(stream, accept):
+        return _stream_ndjson(_metaImpl.iter_all(authorization))
+    return await _metaImpl.find_all(cursor, authorization)
 
 @app.post("/admin/forceNotate")
-def force_notate(metasheet: dict,
+async def force_notate(metasheet: dict,
          authorization: Union[str, None] = Header(default=None)) -> str:
     """ Admin only: add a doc to the metarepo without validation """
-    authorization = authenticate(authorization)
-    check_authorization(authorization)
+    authorization = await _authenticate(authorization)
 
-    ret_val = _metaImpl.force_notate(metasheet, authorization)
+    ret_val = await _metaImpl.force_notate(metasheet, authorization)
 
     return ret_val
+
+@app.post("/admin/reloadPlugins")
+async def reload_plugins(authorization: Union[str, None] = Header(default=None)) -> str:
+    """ Admin only: pick up new or changed sites, targets and repos without a restart """
+    authorization = await _authenticate(authorization)
+
+    return _metaImpl.reload(authorization)
+
+@app.post("/admin/profiling")
+async def profiling(profiling_body: ProfilingBody,
+         authorization: Union[str, None] = Header(default=None)) -> dict:
+    """ Admin only: set the fraction of this worker's requests that are profiled """
+    authorization = await _authenticate(authorization)
+
+    return _metaImpl.set_profiling(profiling_body.sampleRate, authorization)
+
+@app.get("/metrics")
+def metrics():
+    """ Per stage latency histograms and cache counters, in Prometheus text format """
+    body = (_metrics.render()
+            + _metrics.render_stats("metarepo_auth_cache", "Token cache", cache_stats())
+            + _metrics.render_stats("metarepo_find_cache", "Find cache", _findcache.cache_stats()))
+    return Response(body, media_type="text/plain; version=0.0.4")
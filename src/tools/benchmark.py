@@ -0,0 +1,544 @@
+""" A load testing harness for MetaRepo, so throughput and latency can be compared between commits.
+
+For each backend and scale asked for, this starts MetaRepo under uvicorn in its own process, with
+its own config in a scratch directory, seeds the repo with synthetic DT4D and Job metasheets, then
+runs a mixed notate/update/find/get workload at a fixed concurrency. Auth goes to a stub auth
+service run by the harness, which accepts any token. The Elasticsearch backend runs against an
+in-memory stand-in for the elasticsearch client, so it measures MetaRepo's side of the work, not a
+cluster's. Results, including throughput, p50/p95/p99 latency per operation and the server's peak
+RSS, are written out as JSON:
+
+    python src/tools/benchmark.py --backends sql,local --sizes 10000,100000 --output results.json
+"""
+import argparse
+import asyncio
+import configparser
+import copy
+import importlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+_SRC_DIR = os.path.dirname(_TOOLS_DIR)
+_ROOT_DIR = os.path.dirname(_SRC_DIR)
+
+_BACKENDS = {"sql": "SQLRepository", "local": "LocalRepository", "elasticsearch": "ElasticsearchRepository"}
+_TENANT = "bench-tenant"
+_ADMIN_GROUP = "bench-admins"
+_USER = {"username": "bench", "expiresAt": 4102444800000, # 2100-01-01, in ms
+         "ownerGroups": [{"idmGroupId": _TENANT}, {"idmGroupId": _ADMIN_GROUP}]}
+_SEED_CHUNK = 2000
+
+
+### SYNTHETIC METASHEETS
+
+def _doc_id(num):
+    return f"bench-{num:08d}"
+
+def _batch(num, size):
+    """ Every metasheet belongs to a batch of about 50, which finds filter on """
+    return f"b{num % max(1, size // 50)}"
+
+def notate_body(num, size):
+    """ A valid /notate body for a new metasheet, alternating between DT4D files and jobs """
+    site_metadata = {"type": "SIM", "tenant": _TENANT, "workflowId": f"wf{num % 97}",
+                     "parentWorkflowId": f"wf{num % 89}", "originatorWorkflowId": f"wf{num % 83}"}
+    if num % 2:
+        target_class = "JobTarget"
+        target_metadata = {"status": "DONE", "nativeStatus": "COMPLETED", "emitTime": str(num),
+                           "receivedTime": str(num + 1), "nativeId": f"job{num}",
+                           "parentJobId": f"job{num // 2}", "originJobId": "job0", "computeType": "HPC"}
+    else:
+        target_class = "DT4DTarget"
+        target_metadata = {"fileName": f"file{num}.h5", "filePath": f"/data/{num % 1000}/file{num}.h5",
+                           "fileSize": str(1024 * (num % 4096)), "storageKey": f"key{num}",
+                           "bucketName": "bench-bucket"}
+    return {"docSetId": [f"set{num % 101}"], "displayName": f"sheet {num}",
+            "userMetadata": {"batch": _batch(num, size), "project": f"p{num % 7}"},
+            "siteClass": "DT4DSite", "siteMetadata": site_metadata,
+            "targetClass": target_class, "targetMetadata": target_metadata}
+
+def metasheet(num, size, archive_length):
+    """ A complete stored metasheet for seeding, as if it had been updated archive_length times """
+    body = notate_body(num, size)
+    created = 1.6e9 + num
+    doc = {"docId": _doc_id(num), "docSetId": body["docSetId"], "status": 1,
+           "displayName": body["displayName"], "timestamp": created,
+           "userMetadata": body["userMetadata"], "siteClass": body["siteClass"],
+           "siteMetadata": dict(body["siteMetadata"], versionMajor=1, versionMinor=0, versionPatch=0,
+                                userId=_USER["username"]),
+           "targetClass": body["targetClass"], "targetMetadata": body["targetMetadata"],
+           "frameworkArchive": [], "metadataArchive": [], "targetMetadataArchive": [],
+           "siteMetadataArchive": []}
+    # Spread the history over the archives the way real updates would, mostly user metadata
+    for idx in range(archive_length):
+        entry = {"timestamp": created + idx + 1, "userId": _USER["username"],
+                 "comment": f"revision {idx}", "previous": {}}
+        if idx % 4 == 0:
+            entry["previous"] = {"displayName": f"sheet {num} draft {idx}"}
+            doc["frameworkArchive"].append(entry)
+        else:
+            entry["previous"] = dict(body["userMetadata"], revision=str(idx))
+            doc["metadataArchive"].append(entry)
+    return doc
+
+
+### AUTH STUB
+
+class _AuthHandler(BaseHTTPRequestHandler):
+    """ Answers every checkAuth call with the same admin user """
+    def do_POST(self): # pylint: disable=invalid-name
+        body = json.dumps(_USER).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+def start_auth_stub():
+    """ Run the stub auth service on a free port, returning the server """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _AuthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+### ELASTICSEARCH STAND-IN
+
+def _get_path(source, field):
+    for part in field.split('.'):
+        if not isinstance(source, dict) or part not in source:
+            return None
+        source = source[part]
+    return source
+
+def _matches(source, query):
+    """ Evaluate the subset of the query DSL that ElasticsearchRepository builds """
+    if "match_all" in query:
+        return True
+    if "match" in query or "term" in query:
+        field, val = next(iter((query.get("match") or query.get("term")).items()))
+        return _get_path(source, field) == val
+    if "bool" in query:
+        must = query["bool"].get("must", []) + query["bool"].get("filter", [])
+        should = query["bool"].get("should", [])
+        return all(_matches(source, sub) for sub in must) and (not should or any(_matches(source, sub) for sub in should))
+    raise ValueError(f"The stand-in doesn't understand query {query}")
+
+def _api_error(error_class, message):
+    """ Build one of the elasticsearch client's errors without going through its constructor,
+    whose signature has changed between versions """
+    error = error_class.__new__(error_class)
+    Exception.__init__(error, message)
+    error.meta, error.body, error.errors = None, {}, ()
+    return error
+
+
+class StandInElasticsearch:
+    """ An in-memory stand in for the elasticsearch client, implementing just the calls the
+    Elasticsearch repo makes. Documents live in a dict, with sequence numbers for if_seq_no """
+
+    def __init__(self, repo_module, project):
+        self.repo_module = repo_module
+        self.project = project
+        self.docs = {} # docId -> (source, seq_no)
+        self.seq_no = 0
+        self.pits = {} # pit id -> docIds in the point in time
+        self.lock = threading.Lock()
+        self.indices = types.SimpleNamespace(exists=lambda index=None: True) # There's only ever the one
+
+    def _project(self, source, source_includes):
+        if source_includes is None:
+            return copy.deepcopy(source)
+        return copy.deepcopy(self.project(source, [field for field in source_includes if field != "docId"]))
+
+    def search(self, query=None, size=10, from_=0, sort=None, pit=None, search_after=None,
+               source_includes=None, index=None): # pylint: disable=unused-argument
+        with self.lock:
+            if pit is not None:
+                doc_ids = self.pits[pit["id"]]
+                start = search_after[0] + 1 if search_after else 0
+                skip = 0
+            else:
+                doc_ids = list(self.docs)
+                start = 0
+                skip = from_ # from_ counts matches, not documents
+            hits = []
+            for pos in range(start, len(doc_ids)):
+                entry = self.docs.get(doc_ids[pos])
+                if entry is None or not _matches(entry[0], query):
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    continue
+                hits.append({"_id": doc_ids[pos], "_source": self._project(entry[0], source_includes),
+                             "sort": [pos]})
+                if len(hits) == size:
+                    break
+        result = {"hits": {"hits": hits}}
+        if pit is not None:
+            result["pit_id"] = pit["id"]
+        return result
+
+    def open_point_in_time(self, index=None, keep_alive=None): # pylint: disable=unused-argument
+        with self.lock:
+            pit_id = str(len(self.pits))
+            self.pits[pit_id] = list(self.docs)
+        return {"id": pit_id}
+
+    def close_point_in_time(self, id=None): # pylint: disable=redefined-builtin
+        with self.lock:
+            self.pits.pop(id, None)
+
+    def get(self, index=None, id=None): # pylint: disable=unused-argument,redefined-builtin
+        with self.lock:
+            if id not in self.docs:
+                raise _api_error(self.repo_module.NotFoundError, f"{id} not found")
+            source, seq_no = self.docs[id]
+            return {"_id": id, "_source": copy.deepcopy(source), "_seq_no": seq_no, "_primary_term": 1}
+
+    def mget(self, index=None, ids=None): # pylint: disable=unused-argument
+        with self.lock:
+            return {"docs": [{"_id": doc_id, "found": doc_id in self.docs,
+                              "_source": copy.deepcopy(self.docs[doc_id][0]) if doc_id in self.docs else None}
+                             for doc_id in ids]}
+
+    def _create(self, doc_id, document):
+        if doc_id in self.docs:
+            raise _api_error(self.repo_module.ConflictError, f"{doc_id} already exists")
+        self.seq_no += 1
+        self.docs[doc_id] = (copy.deepcopy(document), self.seq_no)
+
+    def create(self, index=None, id=None, document=None): # pylint: disable=unused-argument,redefined-builtin
+        with self.lock:
+            self._create(id, document)
+
+    def bulk_actions(self, actions):
+        with self.lock:
+            for action in actions:
+                self._create(action["_id"], action["_source"])
+        return len(actions), []
+
+    def update(self, index=None, id=None, doc=None, refresh=None, if_seq_no=None, if_primary_term=None): # pylint: disable=unused-argument,redefined-builtin
+        with self.lock:
+            if id not in self.docs:
+                raise _api_error(self.repo_module.NotFoundError, f"{id} not found")
+            source, seq_no = self.docs[id]
+            if if_seq_no is not None and if_seq_no != seq_no:
+                raise _api_error(self.repo_module.ConflictError, f"{id} has changed")
+            self.seq_no += 1
+            self.docs[id] = (dict(source, **copy.deepcopy(doc)), self.seq_no)
+            return {"_id": id, "result": "updated"}
+
+    def close(self):
+        pass
+
+
+class AsyncStandInElasticsearch:
+    """ The async client's interface over the same documents """
+    def __init__(self, sync_client):
+        self.sync_client = sync_client
+        for name in ["search", "open_point_in_time", "close_point_in_time", "get", "mget",
+                     "create", "update", "close"]:
+            setattr(self, name, self._wrap(getattr(sync_client, name)))
+        self.indices = types.SimpleNamespace(exists=self._wrap(sync_client.indices.exists))
+
+    @staticmethod
+    def _wrap(func):
+        async def call(*args, **kwargs):
+            return func(*args, **kwargs)
+        return call
+
+
+def install_elasticsearch_stand_in(repo_module):
+    """ Point the Elasticsearch repo module at the stand-in clients and bulk helpers """
+    client = StandInElasticsearch(repo_module, importlib.import_module("Repository.RepositoryBase").project)
+    async_client = AsyncStandInElasticsearch(client)
+
+    async def async_bulk(els, actions):
+        return els.sync_client.bulk_actions(list(actions))
+
+    repo_module._client = client # pylint: disable=protected-access
+    repo_module._async_client = async_client # pylint: disable=protected-access
+    repo_module.helpers = types.SimpleNamespace(bulk=lambda els, actions: els.bulk_actions(list(actions)))
+    repo_module.async_bulk = async_bulk
+
+
+### SERVER SIDE
+
+def serve(args):
+    """ Run in the server process: seed the repo, then start MetaRepo. The scratch directory is
+    the working directory, so MetaRepo reads the metarepo.conf the harness wrote there """
+    sys.path[:0] = [_ROOT_DIR, _SRC_DIR]
+    repotype = _BACKENDS[args.backend]
+    try:
+        repo_module = importlib.import_module(f"Repository.{repotype}")
+    except ImportError as exc:
+        print(f"Cannot run the {args.backend} backend: {exc}", file=sys.stderr)
+        sys.exit(3)
+    if args.backend == "elasticsearch":
+        install_elasticsearch_stand_in(repo_module)
+
+    start = time.time()
+    repo = getattr(repo_module, repotype)()
+    for first in range(0, args.size, _SEED_CHUNK):
+        repo.restore_many([metasheet(num, args.size, args.archive_length)
+                           for num in range(first, min(first + _SEED_CHUNK, args.size))])
+    with open("seed.json", "w", encoding="utf-8") as fout:
+        json.dump({"seconds": time.time() - start, "count": args.size}, fout)
+
+    import uvicorn # pylint: disable=import-outside-toplevel
+    from src.metarepo import app # pylint: disable=import-outside-toplevel
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+### LOAD GENERATOR
+
+def _percentile(ordered, fraction):
+    """ Nearest rank percentile of an already sorted list, in milliseconds """
+    if not ordered:
+        return None
+    rank = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return round(ordered[rank] * 1000, 3)
+
+def summarize(latencies, errors, elapsed):
+    """ Throughput and latency percentiles for one operation's latencies, in seconds """
+    ordered = sorted(latencies)
+    return {"count": len(ordered), "errors": errors,
+            "throughput": round(len(ordered) / elapsed, 2) if elapsed else None,
+            "p50_ms": _percentile(ordered, 0.50), "p95_ms": _percentile(ordered, 0.95),
+            "p99_ms": _percentile(ordered, 0.99)}
+
+def parse_mix(mix):
+    """ Turn "notate=0.2,update=0.3,find=0.5" into operations and weights """
+    ops = {}
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        if name not in ("notate", "update", "find", "get"):
+            raise ValueError(f"Unknown operation {name}")
+        ops[name] = float(weight)
+    return list(ops), list(ops.values())
+
+async def run_workload(base_url, size, mix, concurrency, duration, warmup, seed):
+    """ Run concurrency workers for warmup + duration seconds, only recording after the warmup """
+    import httpx # pylint: disable=import-outside-toplevel
+    ops, weights = parse_mix(mix)
+    headers = {"Authorization": "Bearer bench-token"}
+    known = list(range(size))
+    next_num = [size]
+    latencies = {op: [] for op in ops}
+    errors = {op: 0 for op in ops}
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    record_from = start + warmup
+    stop_at = record_from + duration
+
+    async def request(client, op):
+        if op == "notate":
+            num = next_num[0]
+            next_num[0] += 1
+            res = await client.post("/notate", json=notate_body(num, size))
+            if res.status_code == 200:
+                known.append(num)
+            return res
+        num = rng.choice(known)
+        if op == "update":
+            return await client.post("/notate", json={
+                "docId": _doc_id(num), "archiveComment": "bench",
+                "userMetadata": {"batch": _batch(num, size), "project": f"p{num % 7}",
+                                 "revision": str(rng.randrange(1000000))}})
+        if op == "get":
+            return await client.get(f"/doc/{_doc_id(num)}")
+        return await client.request("GET", "/find", json={
+            "filters": {"userMetadata.batch": _batch(num, size), "siteMetadata.tenant": _TENANT}})
+
+    async def worker(client):
+        while True:
+            op = rng.choices(ops, weights)[0]
+            began = time.perf_counter()
+            if began >= stop_at:
+                return
+            try:
+                res = await request(client, op)
+                failed = res.status_code != 200
+            except Exception: # pylint: disable=broad-except
+                failed = True
+            finished = time.perf_counter()
+            if began >= record_from:
+                if failed:
+                    errors[op] += 1
+                else:
+                    latencies[op].append(finished - began)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - record_from
+
+    results = {op: summarize(latencies[op], errors[op], elapsed) for op in ops}
+    all_latencies = [latency for op in ops for latency in latencies[op]]
+    results["all"] = summarize(all_latencies, sum(errors.values()), elapsed)
+    return results
+
+
+### HARNESS
+
+def _write_config(workdir, backend, auth_url, overrides):
+    repo_config = configparser.ConfigParser()
+    repo_config["BASE"] = {"repotype": _BACKENDS[backend]}
+    repo_config["ADMIN"] = {"admin_group": _ADMIN_GROUP}
+    repo_config["AUTHSERVICE"] = {"admin_url": auth_url, "checkAuth_endpoint": "/checkAuth"}
+    repo_config["SQL"] = {"db_filename": "bench.db"}
+    repo_config["LOCAL"] = {"local_file": "bench.repo"}
+    # Never used, the stand-in client replaces the real one
+    repo_config["ELASTICSEARCH"] = {"elastic_url": "http://127.0.0.1:9", "cert_fingerprint": "",
+                                    "elastic_user": "", "elastic_password": ""}
+    for override in overrides:
+        key, val = override.split('=', 1)
+        section, option = key.split('.', 1)
+        if not repo_config.has_section(section):
+            repo_config.add_section(section)
+        repo_config.set(section, option, val)
+    with open(os.path.join(workdir, "metarepo.conf"), "w", encoding="utf-8") as fout:
+        repo_config.write(fout)
+
+def _peak_rss_kb(pid):
+    """ The high water mark of a process's resident memory, where /proc has it """
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _wait_for_server(base_url, server, timeout):
+    """ The server only listens once seeding is done, so wait for it to answer """
+    import httpx # pylint: disable=import-outside-toplevel
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            return False
+        try:
+            httpx.get(f"{base_url}/doc/ready", headers={"Authorization": "Bearer bench-token"}, timeout=5)
+            return True
+        except httpx.TransportError:
+            time.sleep(0.5)
+    return False
+
+def _free_port():
+    import socket # pylint: disable=import-outside-toplevel
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def run_case(args, backend, size, auth_url):
+    """ Benchmark one backend at one scale, in a fresh server process and scratch directory """
+    workdir = tempfile.mkdtemp(prefix=f"metarepo-bench-{backend}-")
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    case = {"backend": backend, "size": size, "archive_length": args.archive_length,
+            "concurrency": args.concurrency, "duration": args.duration, "mix": args.mix}
+    _write_config(workdir, backend, auth_url, args.set)
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve",
+                               "--backend", backend, "--size", str(size),
+                               "--archive-length", str(args.archive_length), "--port", str(port)],
+                              cwd=workdir)
+    try:
+        if not _wait_for_server(base_url, server, args.startup_timeout):
+            case["skipped"] = f"server exited with code {server.poll()}" if server.poll() is not None \
+                              else "server did not start in time"
+            return case
+        with open(os.path.join(workdir, "seed.json"), encoding="utf-8") as fin:
+            case["seed_seconds"] = round(json.load(fin)["seconds"], 3)
+        case["operations"] = asyncio.run(run_workload(base_url, size, args.mix, args.concurrency,
+                                                      args.duration, args.warmup, args.seed))
+        case["peak_rss_kb"] = _peak_rss_kb(server.pid)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return case
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=_ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """ Run every backend at every scale, then write the results as JSON """
+    parser = argparse.ArgumentParser(description="Measure MetaRepo throughput and latency")
+    parser.add_argument("--backends", default="sql,local,elasticsearch",
+                        help="Comma separated backends to run: sql, local, elasticsearch (default all)")
+    parser.add_argument("--sizes", default="10000",
+                        help="Comma separated numbers of metasheets to seed, like 10000,100000,1000000 (default 10000)")
+    parser.add_argument("--archive-length", type=int, default=20,
+                        help="Archive entries per seeded metasheet (default 20)")
+    parser.add_argument("--mix", default="notate=0.2,update=0.3,find=0.4,get=0.1",
+                        help="Relative weights of each operation (default notate=0.2,update=0.3,find=0.4,get=0.1)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once (default 16)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to measure for (default 30)")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds to run before measuring (default 5)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the workload (default 0)")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.key=value",
+                        help="Override a MetaRepo config option, for example CACHE.enabled=true")
+    parser.add_argument("--startup-timeout", type=float, default=3600,
+                        help="Seconds to wait for seeding and startup (default 3600)")
+    parser.add_argument("--output", help="File to write the JSON results to (default stdout)")
+    parser.add_argument("--keep", action="store_true", help="Keep each run's scratch directory")
+    # Used by the harness to start each server
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--backend", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    backends = args.backends.split(',')
+    for backend in backends:
+        if backend not in _BACKENDS:
+            sys.exit(f"Unknown backend {backend}. Options are: {', '.join(_BACKENDS)}")
+    parse_mix(args.mix)
+
+    started = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    auth = start_auth_stub()
+    auth_url = f"http://127.0.0.1:{auth.server_address[1]}"
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for backend in backends:
+            print(f"Running {backend} with {size} metasheets", file=sys.stderr)
+            results.append(run_case(args, backend, size, auth_url))
+    auth.shutdown()
+
+    report = {"commit": _git_commit(), "started": started,
+              "python": sys.version.split()[0], "results": results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            fout.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+""" A script to copy every metasheet from one repo straight into another, without going through
+a running MetaRepo. Each repo is opened from its own config file, so they can be different types
+(for example, moving from SQLRepository to ElasticsearchRepository) or the same type pointed at
+different places.
+
+Metasheets are streamed out of the source a page at a time and written to the destination in
+chunks with its bulk write, restore_many, which keeps archives. Every chunk is read back and
+checked as it's written, and once the copy is done the destination is counted """
+import argparse
+import configparser
+import hashlib
+import importlib.util
+import os
+import sys
+import time
+
+# Repos live in src/Repository and import each other as Repository.<name>
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException # pylint: disable=wrong-import-position
+from Repository.RepositoryBase import ARCHIVE_FIELDS, metasheet_etag # pylint: disable=wrong-import-position
+
+_METADATA_TYPES = ['userMetadata', 'siteMetadata', 'targetMetadata']
+# Destinations that rebuild archives from their own history rather than storing them as given.
+# The SQL repo doesn't keep archive userIds or comments, so by default only current state is compared
+_CURRENT_STATE_REPOS = {"SQLRepository"}
+
+
+def open_repo(config_file, label):
+    """ Load a fresh copy of the repo module a config file names, and point it at that config.
+    Repos keep connections and other state in their module, so the source and destination each
+    get their own copy, even when they're the same type """
+    repo_config = configparser.ConfigParser()
+    if not repo_config.read(config_file):
+        sys.exit(f"Could not read config file {config_file}")
+    repotype = repo_config.get("BASE", "repotype", fallback=None)
+    repo_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Repository")
+    module_file = os.path.join(repo_dir, f"{repotype}.py")
+    if repotype is None or not os.path.exists(module_file):
+        sys.exit(f"BASE.repotype {repotype} in {config_file} is not an available repo")
+
+    spec = importlib.util.spec_from_file_location(f"Repository.{repotype}_{label}", module_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.config = repo_config # Repos only read their config when they use it
+    return getattr(module, repotype)()
+
+
+def current_state(metasheet):
+    """ A metasheet without its archives or timestamp, with metadata as strings, for comparing
+    against repos that can't keep everything (SQL rows written before values were typed are
+    strings, for example) """
+    state = {key: val for key, val in metasheet.items() if key not in ARCHIVE_FIELDS and key != "timestamp"}
+    for mType in _METADATA_TYPES:
+        if mType in state:
+            state[mType] = {key: str(val) for key, val in state[mType].items()}
+    return state
+
+
+class _Checksum:
+    """ An order independent checksum over a set of metasheets, with a count """
+    def __init__(self):
+        self.count = 0
+        self.value = 0
+
+    def add(self, etag):
+        self.count += 1
+        self.value ^= int(hashlib.sha256(etag.encode('utf-8')).hexdigest(), 16)
+
+    def __str__(self):
+        return f"{self.count} metasheets, checksum {self.value:064x}"
+
+
+def copy_repo(source, destination, chunk_size=1000, verify="full", progress_interval=10):
+    """ Copy every metasheet from source to destination, checking each chunk after it's written.
+    verify is "full" to compare whole metasheets, "current" to compare only their current state,
+    or "none". Returns the number of metasheets that didn't match """
+    compare = {"full": metasheet_etag,
+               "current": lambda metasheet: metasheet_etag(current_state(metasheet)),
+               "none": None}[verify]
+    source_sum = _Checksum()
+    destination_sum = _Checksum()
+    mismatched = 0
+    reported = 10 # Only name the first few bad metasheets, the count says the rest
+    start = last_report = time.time()
+
+    def write(chunk):
+        nonlocal mismatched, reported
+        destination.restore_many(chunk)
+        if compare is None:
+            return
+        copied = {metasheet["docId"]: metasheet for metasheet in destination.get_many(
+            [metasheet["docId"] for metasheet in chunk])}
+        for metasheet in chunk:
+            expected = compare(metasheet)
+            source_sum.add(expected)
+            found = copied.get(metasheet["docId"])
+            actual = compare(found) if found is not None else None
+            if actual is not None:
+                destination_sum.add(actual)
+            if actual != expected:
+                mismatched += 1
+                if reported > 0:
+                    reported -= 1
+                    problem = "is missing from" if found is None else "differs in"
+                    print(f"{metasheet['docId']} {problem} the destination", file=sys.stderr)
+
+    chunk = []
+    copied_count = 0
+    for metasheet in source.iter_find():
+        chunk.append(metasheet)
+        if len(chunk) >= chunk_size:
+            write(chunk)
+            copied_count += len(chunk)
+            chunk = []
+            if time.time() - last_report >= progress_interval:
+                last_report = time.time()
+                print(f"{copied_count} metasheets copied, {copied_count/(last_report-start):.1f}/s",
+                      file=sys.stderr)
+    if chunk:
+        write(chunk)
+        copied_count += len(chunk)
+    print(f"{copied_count} metasheets copied in {time.time()-start:.1f}s", file=sys.stderr)
+
+    # A destination that wasn't empty, or a copy that skipped something, shows up in the count
+    destination_count = sum(1 for _ in destination.iter_find(fields=["docId"]))
+    if destination_count != copied_count:
+        mismatched += abs(destination_count - copied_count)
+        print(f"The destination holds {destination_count} metasheets, but {copied_count} were copied",
+              file=sys.stderr)
+    if compare is not None:
+        print(f"Source:      {source_sum}", file=sys.stderr)
+        print(f"Destination: {destination_sum}", file=sys.stderr)
+    return mismatched
+
+
+def main():
+    """ Take the two config files from the command line and copy between them """
+    parser = argparse.ArgumentParser(description="Copy every metasheet from one repo directly to another")
+    parser.add_argument("source_config", help="Config file whose BASE.repotype and settings name the source")
+    parser.add_argument("destination_config", help="Config file for the destination, which should be empty")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="Metasheets per destination write (default 1000)")
+    parser.add_argument("--verify", choices=["full", "current", "none"], default=None,
+                        help="Compare whole metasheets, only their current state, or skip checking "
+                             "(default current for an SQLRepository destination, otherwise full)")
+    args = parser.parse_args()
+
+    source = open_repo(args.source_config, "source")
+    destination = open_repo(args.destination_config, "destination")
+    verify = args.verify
+    if verify is None:
+        verify = "current" if type(destination).__name__ in _CURRENT_STATE_REPOS else "full"
+    print(f"Verifying: {verify}", file=sys.stderr)
+    try:
+        mismatched = copy_repo(source, destination, args.chunk_size, verify)
+    except HTTPException as exc:
+        sys.exit(f"Copy failed: {exc.detail}")
+    finally:
+        type(source).close()
+        type(destination).close()
+    if mismatched:
+        sys.exit(f"{mismatched} metasheets did not copy cleanly")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,69 @@
-""" A script to import all of the metasheets from one MetaRepo, and export to another """
+""" A script to import all of the metasheets from one MetaRepo, and export to another
+
+By default this runs pipelined: the next import page is fetched while the current one is being
+exported, a pool of workers export over a shared keep-alive session, failed requests are
+retried with backoff, and a checkpoint file records how far the run got so an interrupted run
+can pick up where it left off. Pass --sequential for the original one at a time behaviour """
+import argparse
+import json
+import os
+import queue
+import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+# Statuses worth trying again, since they usually mean the server is busy rather than the request is bad
+_RETRY_STATUSES = {429, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class TransferError(Exception):
+    """ A request to a metarepo failed. retryable says whether trying again might help """
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _get_session(pool_size=10):
+    """ One pooled, keep-alive session shared by every import and export request """
+    global _session # pylint: disable=global-statement
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                ses = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                ses.mount('http://', adapter)
+                ses.mount('https://', adapter)
+                _session = ses
+    return _session
+
+
+def _check_response(res, direction):
+    """ Turn a non-200 response into a TransferError """
+    if res.status_code != 200:
+        raise TransferError(f"Recieved status code {res.status_code} from {direction} with message: "
+                            f"{res.text}", retryable=res.status_code in _RETRY_STATUSES)
+
+
+def with_retries(func, *args, retries=5, backoff=1.0):
+    """ Call func, retrying connection problems and busy servers with exponential backoff and jitter """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args)
+        except (requests.ConnectionError, requests.Timeout, TransferError) as exc:
+            retryable = not isinstance(exc, TransferError) or exc.retryable
+            if not retryable or attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+    return None # Not reached
+
 
 def identity_transform(metasheet):
     """ This is meant to be overridden by users
@@ -8,58 +71,67 @@ def identity_transform(metasheet):
     By default, do nothing """
     return metasheet
 
-def base_import(params):
+def base_import_pages(params):
     """
-    Import functions take in a set of parameters. This is a base import that will pull from a
-    preexisting metarepo. It needs the metarepo's URL and a token.
+    Page import functions take in a set of parameters, and are generators that yield pages as
+    (list of metasheets, cursor for the next page) until the source is depleted. The cursor is
+    None on the last page. This one pulls from a preexisting metarepo's admin/find_all, and needs
+    the metarepo's URL and a token. An optional 'cursor' starts partway through, and optional
+    'retries' and 'backoff' control retrying.
 
-    Import functions are generators that yield metasheets, one at a time, until the source is depleted
+    The next page is requested as soon as the current one is handed over, so it's usually ready
+    by the time the caller asks for it
     """
-    import_url = params['import_url']
+    import_url = params['import_url'].rstrip('/') # Strip possible trailing slashes
     import_token = params['import_token']
-    if import_url[-1] == '/': # Strip possible trailing slashes
-        import_url = import_url[:-1]
-
-    finished = False
-    page = 0
+    retries = params.get('retries', 5)
+    backoff = params.get('backoff', 1.0)
 
-    while not finished:
-        # This should return a list of up to 1000 metasheets
-        res_im = requests.get(f"{import_url}/metarepo/admin/find_all",
-                          headers={"Authorization" : f"Bearer {import_token}"},
-                          data={"page" : page},
-                          timeout=10)
+    def fetch(cursor):
+        res_im = _get_session().get(f"{import_url}/metarepo/admin/find_all",
+                                    headers={"Authorization" : f"Bearer {import_token}"},
+                                    params={"cursor" : cursor} if cursor else {},
+                                    timeout=10)
+        _check_response(res_im, "import")
+        page = res_im.json()
+        return page["metasheets"], page["cursor"]
 
-        # We should get a list of metasheets
-        # check the status code, process the sheets, then possibly continue
-        if res_im.status_code != 200:
-            sys.exit(f"Recieved status code {res_im.status_code} from import with message: "
-                     f"{res_im.text}")
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = prefetcher.submit(with_retries, fetch, params.get('cursor'),
+                                    retries=retries, backoff=backoff)
+        while pending is not None:
+            metasheets, cursor = pending.result()
+            pending = None
+            if cursor is not None:
+                pending = prefetcher.submit(with_retries, fetch, cursor, retries=retries, backoff=backoff)
+            yield metasheets, cursor
 
-        metasheets = res_im.json()
-        for metasheet in metasheets:
-            yield metasheet
+def base_import(params):
+    """
+    Import functions take in a set of parameters. This is a base import that will pull from a
+    preexisting metarepo. It needs the metarepo's URL and a token.
 
-        if len(metasheets) < 1000 :
-            finished = True
+    Import functions are generators that yield metasheets, one at a time, until the source is depleted
+    """
+    for metasheets, _ in base_import_pages(params):
+        yield from metasheets
 
 def base_export(metasheet, params):
     """ Export functions take in a metasheet and a set of parameters, then put them *somewhere*.
-    This base_export will put it to a preexisting metarepo. It needs the metarepo's URL and a token."""
+    This base_export will put it to a preexisting metarepo. It needs the metarepo's URL and a token.
+    Failures are raised as a TransferError. A metasheet the destination already has counts as
+    exported, so sending a page again after a resume is safe"""
 
-    export_url = params['export_url']
+    export_url = params['export_url'].rstrip('/')
     export_token = params['export_token']
-    if export_url[-1] == '/':
-        export_url = export_url[:-1]
 
-    res_ex = requests.post(f"{export_url}/metarepo/admin/forceNotate",
-                      headers={"Authorization" : f"Bearer {export_token}"},
-                      data={"metasheet" : metasheet},
-                      timeout=10)
-
-    if res_ex.status_code != 200:
-        sys.exit(f"Recieved status code {res_ex.status_code} from export with message: "
-                 f"{res_ex.text}")
+    res_ex = _get_session().post(f"{export_url}/metarepo/admin/forceNotate",
+                                 headers={"Authorization" : f"Bearer {export_token}"},
+                                 json=metasheet,
+                                 timeout=10)
+    if res_ex.status_code == 500 and "already exists" in res_ex.text:
+        return
+    _check_response(res_ex, "export")
 
 def import_export(import_function=base_import, import_params={},
                   export_function=base_export, export_params={},
@@ -67,29 +139,208 @@ def import_export(import_function=base_import, import_params={},
     """ Import metasheets from one location, perform an optional transformation, then export
     the transformed and filtered metasheets to another location"""
 
-    for metasheet in import_function(import_params):
-        metasheet =  transform(metasheet)
-        if not metasheet:
-            continue
+    try:
+        for metasheet in import_function(import_params):
+            metasheet =  transform(metasheet)
+            if not metasheet:
+                continue
+
+            export_function(metasheet, export_params)
+    except TransferError as exc:
+        sys.exit(str(exc))
+
+
+def _read_checkpoint(checkpoint):
+    """ The saved progress of an earlier run, if there is one """
+    state = {"cursor": None, "exported": 0, "failed": 0, "failedDocIds": [], "finished": False}
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return state
+    with open(checkpoint, encoding="utf-8") as fin:
+        state.update(json.load(fin))
+    return state
+
+def _write_checkpoint(checkpoint, state):
+    """ Save progress atomically, so a crash mid write can't lose the previous checkpoint """
+    if checkpoint is None:
+        return
+    tmp = checkpoint + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fout:
+        json.dump(state, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp, checkpoint)
+
+
+class _Progress:
+    """ Counts exports and prints throughput, plus an ETA when the total is known """
+    def __init__(self, total=None, done=0, interval=10):
+        self.total = total
+        self.done = done
+        self.failed = 0
+        self.interval = interval
+        self.start = time.time()
+        self.start_done = done
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def add(self, failed=False):
+        with self.lock:
+            self.done += 1
+            self.failed += failed
 
-        export_function(metasheet, export_params)
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        with self.lock:
+            done, failed = self.done, self.failed
+        rate = (done - self.start_done) / max(now - self.start, 1e-9)
+        message = f"{done} metasheets processed ({failed} failed), {rate:.1f}/s"
+        if self.total:
+            remaining = max(self.total - done, 0)
+            eta = remaining / rate if rate > 0 else float('inf')
+            message += f", {100*done/self.total:.1f}% done, ETA {eta/60:.1f} min"
+        print(message, file=sys.stderr)
 
 
+def pipelined_import_export(import_pages_function=base_import_pages, import_params={},
+                            export_function=base_export, export_params={},
+                            transform=identity_transform, workers=8, queue_size=1000,
+                            checkpoint=None, retries=5, backoff=1.0, total=None,
+                            progress_interval=10):
+    """ The same as import_export, but with workers exporting concurrently from a bounded queue,
+    so a slow export never lets the import run away with memory.
+
+    If checkpoint names a file, the cursor after the last page whose metasheets have all been
+    exported is saved there, and a later run with the same file resumes from it. Metasheets from
+    a page that was only partly exported are sent again on resume, which the export function must
+    allow (base_export does). Exports that still fail after retrying are reported, counted and
+    listed in the checkpoint, and don't stop the run. The checkpoint never moves past a page with
+    a failure, so resuming retries it. Returns the number of failures """
+    state = _read_checkpoint(checkpoint)
+    if state["finished"]:
+        print(f"{checkpoint} records a finished run, nothing to do", file=sys.stderr)
+        return state["failed"]
+    if state["failedDocIds"]:
+        print(f"Retrying from the page with {len(state['failedDocIds'])} earlier failures", file=sys.stderr)
+    import_params = dict(import_params, cursor=state["cursor"], retries=retries, backoff=backoff)
+    _get_session(workers + 1)
+
+    progress = _Progress(total, state["exported"], progress_interval)
+    work = queue.Queue(maxsize=queue_size)
+    # Pages are only checkpointed in order, once every metasheet in them has been exported
+    outstanding = {} # page number -> metasheets not yet handled
+    cursors = {} # page number -> cursor after that page
+    next_checkpoint = [0]
+    saved_cursor = [state["cursor"]]
+    failed_pages = set() # Pages with a failed export, which the checkpoint stops in front of
+    failed_ids = []
+    lock = threading.Lock()
+
+    def save(finished=False):
+        """ Must be called with lock held """
+        _write_checkpoint(checkpoint, {"cursor": saved_cursor[0], "exported": progress.done,
+                                       "failed": progress.failed, "failedDocIds": failed_ids,
+                                       "finished": finished})
+
+    def page_done(page_num, failed_id=None):
+        """ Must be called with lock held """
+        if failed_id is not None:
+            failed_pages.add(page_num)
+            failed_ids.append(failed_id)
+        outstanding[page_num] -= 1
+        while outstanding.get(next_checkpoint[0]) == 0 and next_checkpoint[0] not in failed_pages:
+            num = next_checkpoint[0]
+            saved_cursor[0] = cursors.pop(num)
+            del outstanding[num]
+            next_checkpoint[0] += 1
+            save(finished=saved_cursor[0] is None)
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            page_num, metasheet = item
+            failed_id = None
+            try:
+                with_retries(export_function, metasheet, export_params, retries=retries, backoff=backoff)
+            except Exception as exc: # pylint: disable=broad-except
+                failed_id = metasheet.get('docId')
+                print(f"Export of {failed_id} failed: {exc}", file=sys.stderr)
+            progress.add(failed_id is not None)
+            with lock:
+                page_done(page_num, failed_id)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for page_num, (metasheets, cursor) in enumerate(import_pages_function(import_params)):
+            metasheets = [metasheet for metasheet in map(transform, metasheets) if metasheet]
+            with lock:
+                # The extra count is released once the whole page has been queued, so the page
+                # can't be checkpointed early even if its first metasheets finish straight away
+                outstanding[page_num] = len(metasheets) + 1
+                cursors[page_num] = cursor
+            for metasheet in metasheets:
+                while True:
+                    try:
+                        work.put((page_num, metasheet), timeout=1)
+                        break
+                    except queue.Full:
+                        progress.report()
+            with lock:
+                page_done(page_num)
+            progress.report()
+    finally:
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+                progress.report()
+        if failed_ids:
+            with lock:
+                save()
+            print(f"The checkpoint stops before the first page with a failure. Failed docIds: "
+                  f"{', '.join(map(str, failed_ids))}", file=sys.stderr)
+        progress.report(force=True)
+
+    return progress.failed
+
 
 def main():
     """ By default, we take in arguments from command line and pass them in to import_export """
-    if sys.argv != 5:
-        sys.exit("Usage: import_export.py <import_url> <import_token> <export_url> <export_token>")
-
-    import_url = sys.argv[1]
-    import_token = sys.argv[2]
-    export_url = sys.argv[3]
-    export_token = sys.argv[4]
-    import_params = {'import_url' : import_url,
-                     'import_token' : import_token}
-    export_params = {'export_url' : export_url,
-                     'export_token' : export_token}
-    import_export(base_import, import_params, base_export, export_params)
+    parser = argparse.ArgumentParser(description="Copy every metasheet from one MetaRepo to another")
+    parser.add_argument("import_url")
+    parser.add_argument("import_token")
+    parser.add_argument("export_url")
+    parser.add_argument("export_token")
+    parser.add_argument("--sequential", action="store_true",
+                        help="Export one metasheet at a time, with no retries or checkpoint")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent exports (default 8)")
+    parser.add_argument("--queue-size", type=int, default=1000,
+                        help="Most metasheets waiting to be exported at once (default 1000)")
+    parser.add_argument("--checkpoint", help="File to save progress in, and resume from")
+    parser.add_argument("--retries", type=int, default=5, help="Retries per request (default 5)")
+    parser.add_argument("--total", type=int, help="Expected number of metasheets, for the ETA")
+    args = parser.parse_args()
+
+    import_params = {'import_url' : args.import_url,
+                     'import_token' : args.import_token}
+    export_params = {'export_url' : args.export_url,
+                     'export_token' : args.export_token}
+    if args.sequential:
+        import_export(base_import, import_params, base_export, export_params)
+        return
+    failed = pipelined_import_export(base_import_pages, import_params, base_export, export_params,
+                                     workers=args.workers, queue_size=args.queue_size,
+                                     checkpoint=args.checkpoint, retries=args.retries, total=args.total)
+    if failed:
+        sys.exit(f"{failed} metasheets failed to export")
 
 if __name__ == "__main__":
     main()